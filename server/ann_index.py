@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Approximate nearest neighbour (ANN) index helper module.
+
+Implements an inverted file (IVF) index over an `embedding_store.EmbeddingStore` in pure NumPy:
+
+- Rows are clustered with spherical k-means into `n_lists` inverted lists, each with a unit-length centroid.
+- A query is compared against every centroid, and only rows in the `nprobe` closest lists are scored exactly.
+
+`nprobe` is the recall/speed knob: `nprobe=1` scans roughly `1 / n_lists` of the corpus, while `nprobe=n_lists` scans
+everything and matches exact search.
+
+The index is persisted next to the embedding store (e.g., `documents.ivf.npz` next to `documents.npy`). When rows are
+appended to the store, only the new rows are assigned to their closest list; the centroids are retrained once the
+store has grown well beyond the rows they were trained on.
+
+Build an index ahead of time, or measure recall@k against exact search, with:
+
+```bash
+python ann_index.py build data/embeddings/vast/documents
+python ann_index.py benchmark data/embeddings/vast/documents --k 10
+```
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import embedding_search
+import embedding_store
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+INDEX_VERSION = 1  # bump when the layout of the persisted index changes
+RETRAIN_GROWTH = 4  # retrain centroids once the store has this many times more rows than they were trained on
+ASSIGN_BLOCK_ROWS = 65536  # rows assigned to lists at a time, bounds memory used by the (rows, n_lists) scores
+
+
+def default_n_lists(n_rows):
+    """Returns number of inverted lists for a corpus of `n_rows`, around 4 * sqrt(n_rows)."""
+    return max(1, min(n_rows, int(4 * np.sqrt(n_rows))))
+
+
+def assign_to_lists(vectors, centroids):
+    """Returns index of the closest centroid for each row of unit-length `vectors`."""
+    assignments = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        assignments[start : start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, n_lists, n_iter=20, max_train_rows=256, seed=0):
+    """Returns `(n_lists, dimensions)` unit-length centroids from spherical k-means over `vectors`.
+
+    Trains on a random sample of at most `max_train_rows` rows per list. Empty lists are re-seeded with random rows.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = vectors.shape[0]
+    sample = rng.choice(n_rows, size=min(n_rows, n_lists * max_train_rows), replace=False)
+    sample = np.asarray(vectors[np.sort(sample)], dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_to_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+        centroids = embedding_search.normalize_rows(sums)
+    return centroids
+
+
+class IVFSearchIndex:
+    """Inverted file index with the same `search` interface as `embedding_search.ExactSearchIndex`."""
+
+    def __init__(self, store, centroids, assignments, n_trained, nprobe=8):
+        self.store = store
+        self.metadata = store.metadata
+        self.vectors = store.vectors if store.info.get("normalized") else embedding_search.normalize_rows(store.vectors)
+        self.centroids = centroids
+        self.n_trained = n_trained
+        self.nprobe = nprobe
+        self._set_assignments(assignments)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    def _set_assignments(self, assignments):
+        """Groups row ids by inverted list, so each list is a contiguous slice of `self.order`."""
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(self.n_lists + 1))
+
+    @classmethod
+    def build(cls, store, n_lists=None, nprobe=8, seed=0):
+        """Trains a new index over every row of `store`."""
+        vectors = store.vectors if store.info.get("normalized") else embedding_search.normalize_rows(store.vectors)
+        n_lists = n_lists if n_lists is not None else default_n_lists(len(store))
+        centroids = train_centroids(vectors, n_lists, seed=seed)
+        return cls(store, centroids, assign_to_lists(vectors, centroids), len(store), nprobe)
+
+    @classmethod
+    def load(cls, store, path, nprobe=8):
+        """Loads index persisted at `path` (without extension) for `store`."""
+        with np.load(f"{path}.ivf.npz") as f:
+            if int(f["version"]) != INDEX_VERSION:
+                raise ValueError(f"index {path} has version {int(f['version'])}, expected {INDEX_VERSION}")
+            return cls(store, f["centroids"], f["assignments"], int(f["n_trained"]), nprobe)
+
+    def save(self, path):
+        """Persists index to `path` (without extension), next to the embedding store."""
+        # np.savez appends `.npz` to paths without it, so keep the extension last
+        np.savez(
+            f"{path}.ivf.tmp.npz",
+            version=INDEX_VERSION,
+            centroids=self.centroids,
+            assignments=self.assignments,
+            n_trained=self.n_trained,
+        )
+        os.replace(f"{path}.ivf.tmp.npz", f"{path}.ivf.npz")
+
+    def add_new_rows(self):
+        """Assigns rows appended to the store since the index was built to their closest list.
+
+        Returns number of rows added.
+        """
+        n_indexed = self.assignments.shape[0]
+        if n_indexed == len(self):
+            return 0
+        new_assignments = assign_to_lists(self.vectors[n_indexed:], self.centroids)
+        self._set_assignments(np.concatenate([self.assignments, new_assignments]))
+        return len(self) - n_indexed
+
+    def search(self, queries, k, nprobe=None):
+        """Returns `(indices, scores)` arrays of shape `(len(queries), k)` for a batch of query embeddings.
+
+        Only rows in the `nprobe` lists closest to each query are scored. If those lists hold fewer than `k` rows,
+        the remaining results are padded with index -1 and score -inf.
+        """
+        nprobe = min(nprobe if nprobe is not None else self.nprobe, self.n_lists)
+        queries = embedding_search.normalize_rows(np.atleast_2d(queries))
+        k = min(k, len(self))
+        probes, _ = embedding_search.top_k(queries @ self.centroids.T, nprobe)
+        all_indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.order[self.offsets[j] : self.offsets[j + 1]] for j in lists])
+            candidates.sort()  # sequential reads from the memory-mapped matrix
+            indices, scores = embedding_search.top_k(self.vectors[candidates] @ query, k)
+            all_indices[i, : indices.shape[1]] = candidates[indices[0]]
+            all_scores[i, : scores.shape[1]] = scores[0]
+        return all_indices, all_scores
+
+
+def load_or_build_ivf_index(store, path, n_lists=None, nprobe=8):
+    """Loads IVF index for `store` persisted at `path`, updating it with any new rows or rebuilding it if needed."""
+    index = None
+    if os.path.isfile(f"{path}.ivf.npz"):
+        try:
+            index = IVFSearchIndex.load(store, path, nprobe)
+        except ValueError as e:
+            print(f" * {e}, rebuilding...")
+    if (
+        index is None
+        or index.assignments.shape[0] > len(store)  # store was replaced with a smaller one
+        or index.centroids.shape[1] != store.dimensions
+        or len(store) > RETRAIN_GROWTH * index.n_trained  # centroids no longer represent the corpus
+        or (n_lists is not None and n_lists != index.n_lists)
+    ):
+        print(f" * building IVF index for {path}...")
+        index = IVFSearchIndex.build(store, n_lists, nprobe)
+        index.save(path)
+    elif index.add_new_rows() > 0:
+        index.save(path)
+    return index
+
+
+def benchmark_recall(store, k=10, n_queries=200, nprobes=(1, 2, 4, 8, 16, 32), n_lists=None, seed=0):
+    """Prints recall@k and query latency of the IVF index against exact search for several values of `nprobe`.
+
+    Queries are rows of the store with a small amount of noise added, so each query has a meaningful neighbourhood.
+    """
+    rng = np.random.default_rng(seed)
+    exact = embedding_search.ExactSearchIndex(store)
+    queries = np.asarray(exact.vectors[rng.choice(len(store), size=min(n_queries, len(store)), replace=False)])
+    queries = queries + rng.normal(scale=0.05 / np.sqrt(store.dimensions), size=queries.shape).astype(np.float32)
+
+    start = time.perf_counter()
+    truth, _ = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    index = IVFSearchIndex.build(store, n_lists)
+    print(f"rows: {len(store)}, lists: {index.n_lists}, build: {time.perf_counter() - start:.2f} s")
+    print(f"exact: {exact_ms:.3f} ms/query")
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            break
+        start = time.perf_counter()
+        found, _ = index.search(queries, k, nprobe)
+        ivf_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(np.intersect1d(t, f)) / k for t, f in zip(truth, found)])
+        print(f"nprobe: {nprobe:>4}, recall@{k}: {recall:.3f}, {ivf_ms:.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or benchmark IVF indexes for embedding stores.")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("store", help="path of embedding store without extension, e.g. data/embeddings/vast/nodes")
+    parser.add_argument("--n-lists", type=int, default=None, help="number of inverted lists (default: 4 * sqrt(rows))")
+    parser.add_argument("--k", type=int, default=10, help="number of neighbours for recall@k")
+    parser.add_argument("--queries", type=int, default=200, help="number of benchmark queries")
+    args = parser.parse_args()
+
+    store = embedding_store.EmbeddingStore.load(args.store)
+    if args.command == "build":
+        index = IVFSearchIndex.build(store, args.n_lists)
+        index.save(args.store)
+        print(f" * wrote IVF index with {index.n_lists} lists over {len(index)} rows to {args.store}.ivf.npz")
+    if args.command == "benchmark":
+        benchmark_recall(store, args.k, args.queries, n_lists=args.n_lists)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Load benchmark for the `/query` endpoint against a local mock of the OpenAI API.
+
+Starts a mock OpenAI API that answers chat and embedding requests after a fixed delay, starts the server with
+`OPENAI_BASE_URL` pointing at the mock, then sends many concurrent `/query` requests and reports throughput and
+latency. Run from this directory, with the data downloaded (see `README.md`):
+
+```bash
+python benchmark_load.py --server flask waitress --requests 64 --concurrency 32 --latency 2
+```
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completion and embedding requests after `server.latency` seconds."""
+
+    protocol_version = "HTTP/1.1"  # keep connections alive, like the OpenAI API
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output readable
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency)
+        if self.path.endswith("/chat/completions"):
+            response = {
+                "model": data["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "Mock response."}}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 3, "total_tokens": 103},
+            }
+        else:
+            inputs = [data["input"]] if isinstance(data["input"], str) else data["input"]
+            dimensions = data.get("dimensions", 1024)
+            response = {
+                "model": data["model"],
+                "data": [{"index": i, "embedding": [1 / dimensions**0.5] * dimensions} for i in range(len(inputs))],
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            }
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_mock_openai(latency, port=0):
+    """Starts mock OpenAI API in a background thread and returns the server."""
+    mock = ThreadingHTTPServer(("localhost", port), MockOpenAIHandler)
+    mock.latency = latency
+    threading.Thread(target=mock.serve_forever, daemon=True).start()
+    return mock
+
+
+def start_server(server, port, mock_port, threads):
+    """Starts `main.py` with `server` mode in a subprocess and waits until it is reachable."""
+    env = {
+        **os.environ,
+        "SERVER": server,
+        "SERVER_THREADS": str(threads),
+        "PORT": str(port),
+        "OPENAI_BASE_URL": f"http://localhost:{mock_port}/v1",
+        "OPENAI_API_KEY": "mock",
+        "OPENAI_MAX_CONCURRENCY": str(threads),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "main.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(600):
+        try:
+            requests.get(f"http://localhost:{port}/", timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with code {process.returncode}")
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("server did not start in time")
+
+
+def send_query(url, i):
+    """Sends one custom chat task to `/query` and returns its latency in seconds."""
+    body = {
+        "model_type": "openai",
+        "model_checkpoint": "gpt-3.5-turbo",
+        "model_settings": {},
+        "dataset": "live",
+        "task": "custom",
+        "task_settings": {"prompt": "Summarize the document."},
+        "documents": [f"Benchmark document {i}. " * 50],
+    }
+    start = time.perf_counter()
+    r = requests.post(url, json=body, timeout=600)
+    r.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run_load(url, n_requests, concurrency):
+    """Sends `n_requests` to `url` from `concurrency` threads and returns wall time and per-request latencies."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(lambda i: send_query(url, i), range(n_requests)))
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent /query calls against a mock OpenAI API.")
+    parser.add_argument("--server", nargs="+", default=["flask", "waitress"], choices=["flask", "waitress"])
+    parser.add_argument("--requests", type=int, default=64, help="number of /query requests to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of requests in flight at once")
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds the mock OpenAI API takes to respond")
+    parser.add_argument("--threads", type=int, default=64, help="SERVER_THREADS for waitress")
+    parser.add_argument("--port", type=int, default=3108, help="port to start the server on")
+    args = parser.parse_args()
+
+    mock = start_mock_openai(args.latency)
+    print(f"mock OpenAI API: {args.latency} s latency, {args.requests} requests, {args.concurrency} concurrent")
+    for server in args.server:
+        process = start_server(server, args.port, mock.server_port, args.threads)
+        try:
+            run_load(f"http://localhost:{args.port}/query", args.concurrency, args.concurrency)  # warm up
+            wall, latencies = run_load(f"http://localhost:{args.port}/query", args.requests, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+        print(
+            f"{server:>8}: {args.requests / wall:.2f} req/s, "
+            f"latency p50 {statistics.median(latencies):.2f} s, max {max(latencies):.2f} s"
+        )
+    mock.shutdown()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Startup benchmark for eager and lazy (`LAZY_STARTUP=1`) loading of the server.
+
+For each mode, measures how long `import main` takes and which heavy dependencies it imports, then starts the server
+and measures how long until it accepts requests (`/healthz`) and until it is ready (`/readyz`). Run from this
+directory, with the data downloaded (see `README.md`):
+
+```bash
+python benchmark_startup.py --mode eager lazy --repeat 3
+```
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+HEAVY_MODULES = ["evaluate", "spacy", "scipy", "sklearn", "pandas", "tiktoken"]
+
+# imports `main` in a fresh interpreter and prints import time and which heavy modules were imported
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "imported": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def get_env(mode, port=None):
+    """Returns environment to run the server in `mode` with."""
+    env = {**os.environ, "LAZY_STARTUP": "1" if mode == "lazy" else "0"}
+    if port is not None:
+        env["PORT"] = str(port)
+    return env
+
+
+def measure_import(mode):
+    """Returns seconds `import main` takes in `mode` and list of heavy modules it imported."""
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], env=get_env(mode), capture_output=True, text=True, check=True
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    return result["seconds"], result["imported"]
+
+
+def measure_startup(mode, port, timeout=600):
+    """Starts the server in `mode` and returns seconds until `/healthz` and `/readyz` respond with 200."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py"], env=get_env(mode, port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    live = None
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with code {process.returncode}")
+            try:
+                if live is None and requests.get(f"http://localhost:{port}/healthz", timeout=1).ok:
+                    live = time.perf_counter() - start
+                if live is not None and requests.get(f"http://localhost:{port}/readyz", timeout=1).ok:
+                    return live, time.perf_counter() - start
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("server did not become ready in time")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark server startup with eager and lazy loading.")
+    parser.add_argument("--mode", nargs="+", default=["eager", "lazy"], choices=["eager", "lazy"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each measurement, the median is reported")
+    parser.add_argument("--port", type=int, default=3109, help="port to start the server on")
+    parser.add_argument("--no-server", action="store_true", help="only measure `import main`")
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        imports = [measure_import(mode) for _ in range(args.repeat)]
+        print(f"{mode:>6}: import main {statistics.median(s for s, _ in imports):.2f} s, imports {imports[-1][1]}")
+        if not args.no_server:
+            startups = [measure_startup(mode, args.port) for _ in range(args.repeat)]
+            print(
+                f"{mode:>6}: live after {statistics.median(s for s, _ in startups):.2f} s, "
+                f"ready after {statistics.median(s for _, s in startups):.2f} s"
+            )
@@ -0,0 +1,133 @@
+"""Corpus index helper module.
+
+`CorpusIndex` keeps the `.txt` documents of a directory (e.g., `data/News Articles`) in memory, so `/documents` does
+not walk the directory and read every file on each request. The directory is re-scanned at most once every
+`refresh_interval` seconds, and only files that are new or whose modification time or size changed are read again.
+
+Each scan that finds a change bumps the `etag` of the corpus, so clients can revalidate their copy with a conditional
+GET instead of downloading the whole corpus again.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+DOCUMENT_FIELDS = ["id", "path", "pathList", "name", "text"]
+
+
+def document_id(path):
+    """Returns id of document at `path`, the same however the path is spelled (e.g. `data/a.txt` or `./data/a.txt`).
+
+    Ids are relative to the working directory like the paths read by `CorpusIndex` (e.g. `./data/News Articles/...`),
+    or absolute for documents outside of it.
+    """
+    path = os.path.realpath(path)
+    relative_path = os.path.relpath(path)
+    if relative_path != os.pardir and not relative_path.startswith(os.pardir + os.sep):
+        path = os.path.join(os.curdir, relative_path)
+    return path.replace(os.sep, "/")  # normalize path
+
+
+def read_document(path, root=None):
+    """Returns dict of document at `path` with its path relative to `root`, or to the directory of `path` if not set."""
+    root = root if root is not None else os.path.dirname(path)
+    name = os.path.basename(path)
+    with open(path, "r", encoding="cp1252", errors="backslashreplace") as f:
+        new_path = os.path.relpath(path, root).replace(os.sep, "/")  # normalize path
+        return {
+            "id": document_id(path),
+            "path": new_path,
+            "pathList": new_path.split("/"),
+            "name": name,
+            "text": f.read(),
+        }
+
+
+def scan_txt_files(path, files):
+    """Adds `(path, (mtime, size))` of `.txt` files nested in `path` to `files` in directory listing order."""
+    if os.path.isdir(path):
+        for x in os.listdir(path):
+            scan_txt_files(os.path.join(path, x), files)
+    elif os.path.basename(path).strip().lower().endswith(".txt"):
+        stat = os.stat(path)
+        files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class CorpusIndex:
+    """In-memory index of the `.txt` documents in `root`, refreshed from file modification times.
+
+    - `refresh_interval`: seconds between scans of `root` for new, changed and deleted files
+    - `max_cached_responses`: serialized (and gzipped) pages of documents kept for repeated requests
+    """
+
+    def __init__(self, root, refresh_interval=5, max_cached_responses=16):
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self.max_cached_responses = max_cached_responses
+        self.etag = None
+        self.documents = []  # documents in directory listing order
+        self._files = {}  # path -> (mtime, size) of indexed files
+        self._by_path = {}  # path -> document
+        self._last_scan = None
+        self._responses = OrderedDict()  # (etag, offset, limit, fields) -> (json, gzipped json)
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Re-scans `root` if `refresh_interval` has passed, reading only new and changed files."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_scan is not None and now - self._last_scan < self.refresh_interval:
+                return
+            files = scan_txt_files(self.root, {})
+            self._last_scan = now
+            if files == self._files and self.etag is not None:
+                return
+
+            changed = {path for path, stat in files.items() if self._files.get(path) != stat}
+            by_path = {path: self._by_path[path] for path in files if path not in changed}
+            for path in changed:
+                by_path[path] = read_document(path, self.root)
+            print(f" * indexed {len(changed)} new or changed documents of {len(files)} in {self.root}")
+
+            self._files = files
+            self._by_path = by_path
+            self.documents = [by_path[path] for path in files]
+            self.etag = hashlib.sha256(json.dumps(sorted(files.items())).encode("utf-8")).hexdigest()[:32]
+            self._responses.clear()
+
+    def get_page(self, offset=0, limit=None, fields=None):
+        """Returns etag of the page, total number of documents, and JSON string and its gzipped bytes of a page.
+
+        - `offset` / `limit`: slice of documents to return, all of them by default
+        - `fields`: list of fields of each document to return, e.g. `["id", "name"]` without the text, all by default
+        """
+        self.refresh()
+        with self._lock:
+            key = (self.etag, offset, limit, tuple(fields) if fields is not None else None)
+            etag = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:32]
+            cached = self._responses.get(key)
+            if cached is None:
+                end = offset + limit if limit is not None else None
+                page = self.documents[offset:end]
+                if fields is not None:
+                    page = [{field: doc[field] for field in fields} for doc in page]
+                body = json.dumps(page, sort_keys=True, separators=(",", ":"))  # same as `jsonify`
+                cached = (body, gzip.compress(body.encode("utf-8"), compresslevel=6))
+                self._responses[key] = cached
+                while len(self._responses) > self.max_cached_responses:
+                    self._responses.popitem(last=False)
+            else:
+                self._responses.move_to_end(key)
+            return etag, len(self.documents), cached[0], cached[1]
@@ -0,0 +1,174 @@
+"""Embedding dataset registry helper module.
+
+A dataset is a directory of pre-computed embeddings with a `documents` and / or a `nodes` embedding store (see
+`embedding_store.py`), e.g. `data/embeddings/vast/`. `DatasetRegistry` hosts many datasets in one server: each one is
+loaded the first time a query uses it, with its matrices memory-mapped, and least recently used datasets are unloaded
+once the loaded datasets take more than `max_memory` bytes.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import ann_index
+import embedding_search
+import embedding_store
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+STORE_NAMES = ["documents", "nodes"]  # embedding stores a dataset directory can have
+
+
+def get_index_nbytes(index):
+    """Returns approximate bytes held by search `index`, counting its matrix and metadata."""
+    nbytes = index.vectors.nbytes + int(index.metadata.memory_usage(deep=True).sum())
+    if index.vectors is not index.store.vectors:
+        nbytes += index.store.vectors.nbytes  # index made a normalized copy of the memory-mapped matrix
+    for name in ["centroids", "assignments", "order", "offsets"]:  # IVF lists
+        if hasattr(index, name):
+            nbytes += getattr(index, name).nbytes
+    return nbytes
+
+
+class Dataset:
+    """Search indexes over the embedding stores of a dataset directory, loaded by `DatasetRegistry`.
+
+    - `indexes`: dict of store name ("documents" or "nodes") to search index
+    - `nbytes`: approximate bytes held by the indexes
+    """
+
+    def __init__(self, name, path, indexes):
+        self.name = name
+        self.path = path
+        self.indexes = indexes
+        self.nbytes = sum(get_index_nbytes(index) for index in indexes.values())
+        self.last_used = time.time()
+
+
+class DatasetRegistry:
+    """Registry of datasets by name, loaded on first use and unloaded by least recent use.
+
+    - `max_memory`: bytes of loaded datasets before least recently used ones are unloaded, None for no limit
+    - `search_index`: "exact" or "ivf", see `SEARCH_INDEX` in `main.py`
+    - `nprobe`: lists scanned per query by "ivf" indexes
+
+    Queries that are still using an unloaded dataset keep their reference to it until they finish.
+    """
+
+    def __init__(self, max_memory=None, search_index="exact", nprobe=8):
+        self.max_memory = max_memory
+        self.search_index = search_index
+        self.nprobe = nprobe
+        self.paths = {}  # name -> dataset directory
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()  # name -> `Dataset`, ordered from least to most recently used
+        self._lock = threading.Lock()
+        self._load_locks = {}  # name -> lock held while the dataset is loading, so it is only loaded once
+
+    def register(self, name, path):
+        """Registers dataset `name` with embedding stores in directory `path`."""
+        with self._lock:
+            self.paths[name] = path
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def discover(self, root):
+        """Registers each directory in `root` with embeddings as a dataset named after it, unless already registered."""
+        registered = {os.path.normpath(path) for path in self.paths.values()}
+        for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            path = os.path.join(root, name)
+            if name in self.paths or os.path.normpath(path) in registered:
+                continue  # already registered, e.g. "vast" as "live"
+            if any(self._has_store(path, store_name) for store_name in STORE_NAMES):
+                self.register(name, path)
+
+    @staticmethod
+    def _has_store(path, store_name):
+        store_path = os.path.join(path, store_name)
+        return embedding_store.store_exists(store_path) or os.path.isfile(f"{store_path}.csv")
+
+    def is_loaded(self, name):
+        """Returns True if dataset `name` is loaded."""
+        with self._lock:
+            return name in self._loaded
+
+    def get(self, name):
+        """Returns loaded `Dataset` named `name`, loading it first if needed. Raises KeyError if `name` is unknown."""
+        if name not in self.paths:
+            raise KeyError(f"unknown dataset: {name}")
+        with self._lock:
+            dataset = self._loaded.get(name)
+            if dataset is not None:
+                self._loaded.move_to_end(name)
+                dataset.last_used = time.time()
+                return dataset
+
+        with self._load_locks[name]:
+            with self._lock:
+                dataset = self._loaded.get(name)  # loaded by another thread while waiting
+            if dataset is None:
+                dataset = self._load(name)
+                with self._lock:
+                    self._loaded[name] = dataset
+                    self.loads += 1
+                    self._evict(keep=name)
+        return dataset
+
+    def unload(self, name):
+        """Unloads dataset `name`, so the next query loads it again (e.g., after rows were added to its stores)."""
+        with self._lock:
+            self._loaded.pop(name, None)
+
+    def _load(self, name):
+        path = self.paths[name]
+        print(f" * loading dataset {name} from {path}...")
+        indexes = {}
+        for store_name in STORE_NAMES:
+            if not self._has_store(path, store_name):
+                continue
+            store_path = os.path.join(path, store_name)
+            store = embedding_store.load_store_from_csv(f"{store_path}.csv")
+            if self.search_index == "ivf":
+                # approximate indexes are persisted next to the stores and updated with any new rows
+                indexes[store_name] = ann_index.load_or_build_ivf_index(store, store_path, nprobe=self.nprobe)
+            else:
+                indexes[store_name] = embedding_search.ExactSearchIndex(store)
+        dataset = Dataset(name, path, indexes)
+        print(f" * dataset {name} loaded ({dataset.nbytes / 2**20:.0f} MB)")
+        return dataset
+
+    def _evict(self, keep):
+        """Unloads least recently used datasets other than `keep` while over `max_memory`, must hold `_lock`."""
+        if self.max_memory is None:
+            return
+        while sum(dataset.nbytes for dataset in self._loaded.values()) > self.max_memory:
+            name = next((x for x in self._loaded if x != keep), None)
+            if name is None:
+                break  # a single dataset over the limit stays loaded
+            print(f" * unloading dataset {name}")
+            del self._loaded[name]
+            self.evictions += 1
+
+    def stats(self):
+        """Returns dict of registered and loaded datasets and memory used."""
+        with self._lock:
+            return {
+                "datasets": {
+                    name: {
+                        "path": path,
+                        "loaded": name in self._loaded,
+                        "mb": self._loaded[name].nbytes / 2**20 if name in self._loaded else None,
+                    }
+                    for name, path in self.paths.items()
+                },
+                "mb": sum(dataset.nbytes for dataset in self._loaded.values()) / 2**20,
+                "max_mb": self.max_memory / 2**20 if self.max_memory is not None else None,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
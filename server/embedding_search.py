@@ -0,0 +1,134 @@
+"""Embedding search helper module.
+
+Scores queries against a corpus of embeddings by cosine similarity. The corpus is L2-normalized once into a float32
+matrix, so scoring a batch of queries is a single matrix product, and the top-k rows of each query are selected with
+`np.argpartition` instead of fully sorting every score.
+
+For very large comparisons, `blocked_top_k` scores tiles of rows at a time and only keeps the running top-k of each
+query, so memory stays bounded no matter how many rows are searched.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+BYTES_PER_SCORE = 16  # float32 score, its negated copy and int64 index, held per score by `top_k`
+
+
+def normalize_rows(matrix):
+    """Returns float32 copy of `matrix` with each row scaled to unit length (zero rows are left as zeros)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k(scores, k):
+    """Returns `(indices, scores)` of the `k` highest `scores` in each row, sorted from highest to lowest.
+
+    Uses `np.argpartition` to select the top `k` in linear time, then only sorts those `k`.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def merge_top_k(indices_a, scores_a, indices_b, scores_b, k):
+    """Returns `(indices, scores)` of the `k` highest scores in each row of two sets of top-k results."""
+    indices = np.concatenate([indices_a, indices_b], axis=1)
+    order, scores = top_k(np.concatenate([scores_a, scores_b], axis=1), k)
+    return np.take_along_axis(indices, order, axis=1), scores
+
+
+def blocked_top_k(queries, vectors, k, max_memory=256 * 2**20, max_workers=1):
+    """Returns `(indices, scores)` like `top_k(queries @ vectors.T, k)`, without computing every score at once.
+
+    Scores are computed in tiles of rows of `queries` by rows of `vectors`, and only the running top `k` of each query
+    is kept between tiles, so at most about `max_memory` bytes of scores are held at once. Rows of `vectors` are split
+    between up to `max_workers` threads, which run on separate cores since NumPy releases the GIL in matrix products.
+    """
+    n_queries, n_vectors = len(queries), len(vectors)
+    k = min(k, n_vectors)
+    if k == 0 or n_queries == 0:
+        return np.empty((n_queries, 0), dtype=np.int64), np.empty((n_queries, 0), dtype=np.float32)
+
+    # size tiles so the tiles of all workers fit in `max_memory`
+    row_block = min(n_queries, 256)
+    col_block = max(k, max_memory // (max_workers * row_block * BYTES_PER_SCORE))
+    n_workers = max(1, min(max_workers, -(-n_vectors // col_block)))
+    bounds = np.linspace(0, n_vectors, n_workers + 1).astype(int)
+
+    def scan(col_start, col_end):
+        all_indices = []
+        all_scores = []
+        for row_start in range(0, n_queries, row_block):
+            rows = queries[row_start : row_start + row_block]
+            indices = np.empty((len(rows), 0), dtype=np.int64)
+            scores = np.empty((len(rows), 0), dtype=np.float32)
+            for tile_start in range(col_start, col_end, col_block):
+                tile = vectors[tile_start : min(tile_start + col_block, col_end)]
+                tile_indices, tile_scores = top_k(rows @ tile.T, k)
+                indices, scores = merge_top_k(indices, scores, tile_indices + tile_start, tile_scores, k)
+            all_indices.append(indices)
+            all_scores.append(scores)
+        return np.concatenate(all_indices), np.concatenate(all_scores)
+
+    if n_workers == 1:
+        return scan(0, n_vectors)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        partial = list(executor.map(scan, bounds[:-1], bounds[1:]))
+    indices, scores = partial[0]
+    for worker_indices, worker_scores in partial[1:]:
+        indices, scores = merge_top_k(indices, scores, worker_indices, worker_scores, k)
+    return indices, scores
+
+
+def iter_top_k_blocks(queries, vectors, k, block_size=1024, max_memory=256 * 2**20, max_workers=1):
+    """Yields `(start, indices, scores)` of the top `k` rows of `vectors` for each block of `block_size` `queries`.
+
+    Rows of both matrices should already be normalized, so scores are cosine similarities. Each block is scored with
+    `blocked_top_k`, so results can be consumed as they are computed while memory stays under `max_memory`.
+    """
+    for start in range(0, len(queries), block_size):
+        block = queries[start : start + block_size]
+        indices, scores = blocked_top_k(block, vectors, k, max_memory, max_workers)
+        if indices.shape[1] == 0:
+            return
+        yield start, indices, scores
+
+
+class ExactSearchIndex:
+    """Brute-force cosine similarity search over every row of an `embedding_store.EmbeddingStore`.
+
+    If the store was normalized when it was built, its memory-mapped matrix is used as is, otherwise a normalized copy
+    is made once when the index is created.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.metadata = store.metadata
+        if store.info.get("normalized"):
+            self.vectors = store.vectors
+        else:
+            self.vectors = normalize_rows(store.vectors)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def search(self, queries, k):
+        """Returns `(indices, scores)` arrays of shape `(len(queries), k)` for a batch of query embeddings."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        return top_k(queries @ self.vectors.T, k)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Embedding store helper module.
+
+Pre-computed embeddings are persisted as a contiguous float32 matrix in `.npy` format, next to a small JSON sidecar
+holding the remaining columns of each row (e.g., "source" and "text" for documents, "node" for nodes):
+
+```
+data/embeddings/vast/
+├── documents.csv        <- original CSV, embeddings stored as strings
+├── documents.npy        <- float32 matrix, one row per embedding
+└── documents.json       <- sidecar with ids and metadata, one entry per row
+```
+
+Rows are L2-normalized when the store is built, so cosine similarity is a plain dot product (see
+`embedding_search.py`). The matrix is memory-mapped when loaded, so startup only reads the sidecar and several worker
+processes share a single copy of the matrix through the OS page cache.
+
+Build a store once from an existing CSV with:
+
+```bash
+python embedding_store.py data/embeddings/vast/documents.csv data/embeddings/vast/nodes.csv
+```
+"""
+
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+import embedding_search
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+STORE_VERSION = 1  # bump when the layout of the matrix or sidecar changes
+
+_store_locks = {}  # store path -> lock held while its files are read or replaced, so a load never mixes two versions
+_store_locks_lock = threading.Lock()
+
+
+def get_store_lock(path):
+    """Returns lock of the files of store at `path`, held by `EmbeddingStore.load` and `write_store`.
+
+    The lock is reentrant, so `ingest.py` holds it from reading the ids already in a store until the new rows are
+    appended, and ingestions into the same store (however its path is spelled) do not add the same rows twice.
+    """
+    with _store_locks_lock:
+        return _store_locks.setdefault(os.path.realpath(path), threading.RLock())
+
+
+class EmbeddingStore:
+    """Memory-mapped embedding matrix with metadata for each row.
+
+    - `vectors`: read-only `(rows, dimensions)` float32 matrix
+    - `metadata`: DataFrame with the non-embedding columns, aligned by row with `vectors`
+    """
+
+    def __init__(self, vectors, metadata, info=None):
+        self.vectors = vectors
+        self.metadata = metadata
+        self.info = info if info is not None else {}
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def dimensions(self):
+        return self.vectors.shape[1]
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Loads store at `path` (without extension), memory-mapping the matrix."""
+        with get_store_lock(path):  # the matrix and sidecar are replaced one after the other by `write_store`
+            with open(f"{path}.json", "r") as f:
+                info = json.load(f)
+            if info.get("version") != STORE_VERSION:
+                raise ValueError(f"embedding store {path} has version {info.get('version')}, expected {STORE_VERSION}")
+            vectors = np.load(f"{path}.npy", mmap_mode=mmap_mode)
+        import pandas as pd  # imported on first load, see `LAZY_STARTUP` in `main.py`
+
+        metadata = pd.DataFrame(info.pop("metadata"), columns=info["columns"])
+        if len(metadata) != vectors.shape[0]:
+            raise ValueError(f"embedding store {path} has {vectors.shape[0]} vectors but {len(metadata)} rows")
+        return cls(vectors, metadata, info)
+
+
+def store_path_from_csv(csv_path):
+    """Returns store path (without extension) that sits next to `csv_path`."""
+    return os.path.splitext(csv_path)[0]
+
+
+def store_exists(path):
+    """Returns True if both the matrix and sidecar of store at `path` exist."""
+    return os.path.isfile(f"{path}.npy") and os.path.isfile(f"{path}.json")
+
+
+def write_store(path, vectors, metadata, source=None, normalized=False):
+    """Writes float32 `vectors` and `metadata` DataFrame to store at `path` (without extension).
+
+    Set `normalized` if every row of `vectors` has unit length, so search indexes can use the matrix directly.
+
+    Files are written to temporary paths first and then moved into place, so processes that have the old matrix
+    memory-mapped are not affected. Both are moved while holding the lock of the store, so `EmbeddingStore.load` in
+    this process never reads the new matrix with the old sidecar.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    info = {
+        "version": STORE_VERSION,
+        "source": source,
+        "rows": int(vectors.shape[0]),
+        "dimensions": int(vectors.shape[1]),
+        "dtype": "float32",
+        "normalized": normalized,
+        "columns": list(metadata.columns),
+        "metadata": {col: metadata[col].tolist() for col in metadata.columns},
+    }
+    # np.save appends `.npy` to paths without it, so keep the extension last
+    np.save(f"{path}.tmp.npy", vectors)
+    with open(f"{path}.tmp.json", "w") as f:
+        json.dump(info, f)
+    with get_store_lock(path):
+        os.replace(f"{path}.tmp.npy", f"{path}.npy")
+        os.replace(f"{path}.tmp.json", f"{path}.json")
+
+
+def append_to_store(path, vectors, metadata):
+    """Appends rows of `vectors` and `metadata` DataFrame to store at `path`, creating the store if it does not exist.
+
+    New rows are L2-normalized if the existing rows are. The whole store is rewritten with `write_store`, so processes
+    that have the old matrix memory-mapped keep reading it until they load the store again. The lock of the store is
+    held until then, so concurrent appends in this process do not drop each other's rows.
+    """
+    import pandas as pd
+
+    with get_store_lock(path):
+        if not store_exists(path):
+            vectors = embedding_search.normalize_rows(vectors)
+            write_store(path, vectors, metadata, source="ingest", normalized=True)
+            return
+        store = EmbeddingStore.load(path)
+        normalized = store.info.get("normalized", False)
+        if normalized:
+            vectors = embedding_search.normalize_rows(vectors)
+        vectors = np.concatenate([store.vectors, np.asarray(vectors, dtype=np.float32)])
+        metadata = metadata.assign(**{col: None for col in store.metadata.columns if col not in metadata.columns})
+        metadata = pd.concat([store.metadata, metadata[store.metadata.columns]], ignore_index=True)
+        write_store(path, vectors, metadata, source=store.info.get("source"), normalized=normalized)
+
+
+def convert_csv(csv_path, path=None):
+    """Converts CSV at `csv_path` with an "embedding" column of list strings into a store at `path`.
+
+    Embedding strings are lists of floats, which are valid JSON, so they are parsed with `json.loads` instead of the
+    much slower `ast.literal_eval`.
+    """
+    import pandas as pd
+
+    if path is None:
+        path = store_path_from_csv(csv_path)
+    df = pd.read_csv(csv_path)
+    vectors = embedding_search.normalize_rows([json.loads(x) for x in df["embedding"]])
+    metadata = df.drop(columns=["embedding"])
+    write_store(path, vectors, metadata, source=os.path.basename(csv_path), normalized=True)
+    return path
+
+
+def load_store_from_csv(csv_path):
+    """Loads store built from `csv_path`, converting the CSV first if the store does not exist yet."""
+    path = store_path_from_csv(csv_path)
+    if not store_exists(path):
+        print(f" * building embedding store from {csv_path} (one time only)...")
+        convert_csv(csv_path, path)
+    return EmbeddingStore.load(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python embedding_store.py <embeddings.csv> [<embeddings.csv> ...]")
+        sys.exit(1)
+    for csv_path in sys.argv[1:]:
+        print(f" * converting {csv_path}...")
+        store = EmbeddingStore.load(convert_csv(csv_path))
+        print(f" * wrote {len(store)} x {store.dimensions} embeddings to {store_path_from_csv(csv_path)}.npy")
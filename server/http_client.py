@@ -0,0 +1,167 @@
+"""HTTP client helper module.
+
+`HTTPClient` wraps a shared `requests.Session`, so calls to the same host reuse pooled keep-alive connections instead
+of paying for a new TCP + TLS handshake each time. Each call has connect / read timeouts, and is retried with
+exponential backoff and full jitter when the server is overloaded (429) or failing (5xx), honouring the `Retry-After`
+header if the server sends one.
+
+A `CircuitBreaker` stops sending requests for a while after several calls in a row have failed, so a struggling
+upstream is not flooded with retries from every request thread.
+"""
+
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}  # statuses worth retrying, the rest are returned as is
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of sending a request while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failed calls in a row and rejects calls for `reset_timeout` seconds.
+
+    After the timeout, a single trial call is let through (half-open). If it succeeds the breaker closes again,
+    otherwise it stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def allow(self):
+        """Returns True if a call may be sent now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True  # half-open, let a single trial call through
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def parse_retry_after(value):
+    """Returns seconds to wait from a `Retry-After` header (delay in seconds or HTTP date), or None if invalid."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPClient:
+    """Connection-pooled HTTP client with timeouts, retries and a circuit breaker.
+
+    - `pool_maxsize`: keep-alive connections kept open per host, set to the number of concurrent request threads
+    - `connect_timeout` / `read_timeout`: seconds to wait for a connection / for the server to send data
+    - `max_retries`: retries after the first attempt for connection errors, timeouts and `RETRY_STATUS_CODES`
+    - `backoff_base` / `backoff_max`: retry `n` waits a random time up to `min(backoff_max, backoff_base * 2 ** n)`
+    """
+
+    def __init__(
+        self,
+        pool_maxsize=16,
+        connect_timeout=10,
+        read_timeout=300,
+        max_retries=4,
+        backoff_base=1,
+        backoff_max=60,
+        circuit_breaker=None,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_backoff(self, attempt, response=None):
+        """Returns seconds to wait before retry `attempt`, using the `Retry-After` header of `response` if present."""
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def post(self, url, headers, data, stream=False):
+        """Sends POST request with `data` string body, retrying failures, and returns the final `requests.Response`.
+
+        Raises `CircuitOpenError` if the circuit breaker is open, or the last `requests.RequestException` if every
+        attempt failed to get a response.
+        """
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError(f"circuit breaker is open, not sending request to {url}")
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                last_attempt = attempt == self.max_retries
+                try:
+                    r = self.session.post(url, headers=headers, data=data, timeout=self.timeout, stream=stream)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if last_attempt:
+                        raise
+                    backoff = self.get_backoff(attempt)
+                    print(f"API request failed ({e.__class__.__name__}), retrying in {backoff:.1f} s...")
+                else:
+                    if r.status_code not in RETRY_STATUS_CODES:
+                        self.circuit_breaker.record_success()
+                        return r
+                    if last_attempt:
+                        self.circuit_breaker.record_failure()
+                        return r
+                    backoff = self.get_backoff(attempt, r)
+                    print(f"API response code: {r.status_code}, retrying in {backoff:.1f} s...")
+                    r.close()  # release connection back to the pool
+                time.sleep(backoff)
+        except BaseException:
+            # no response, e.g. every attempt timed out or the body failed to decode (`ChunkedEncodingError`), which
+            # also ends a half-open trial, otherwise the breaker would wait for the trial forever
+            self.circuit_breaker.record_failure()
+            raise
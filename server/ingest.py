@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Ingestion helper module.
+
+Adds new documents and knowledge graph nodes to the embedding stores of a dataset (see `dataset_registry.py`) without
+rebuilding them:
+
+- Documents are read from `.txt` files, the same way `/documents` reads them, split into chunks of at most
+  `CHUNK_TOKENS` tokens, embedded in batches and appended to the `documents` store (columns "source" and "text").
+- Nodes are names of entities, embedded and appended to the `nodes` store (column "node").
+
+Documents and nodes already in a store, by id or name, are skipped, so nothing is embedded twice. Embeddings go through
+`openai_api.request_embedding_endpoint`, so they are batched, cached and counted in token usage like any other
+request. A persisted IVF index next to the store is updated with the new rows.
+
+Ingest from the command line (the server picks up new rows the next time it loads the dataset, or right away when
+ingesting through `POST /ingest`):
+
+```bash
+python ingest.py data/embeddings/vast --documents "./data/News Articles/new" --nodes new_nodes.txt
+```
+"""
+
+import argparse
+import os
+
+import ann_index
+import corpus_index
+import embedding_store
+import openai_api
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+EMBEDDING_MODEL = "text-embedding-3-large"  # same as `OPENAI_EMBEDDING_MODEL` in `main.py`
+EMBEDDING_DIMENSIONS = 1024  # dimensions of new stores, existing stores keep their own
+CHUNK_TOKENS = 1000  # max tokens of each document chunk that is embedded
+
+def read_txt_files(path, documents=None):
+    """Returns list of `{"id", "text"}` dicts of `.txt` files in `path` (a file or directory, walked recursively).
+
+    Documents are read with `corpus_index.read_document`, so ingested documents have the ids `/documents` sends.
+    """
+    documents = [] if documents is None else documents
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            read_txt_files(os.path.join(path, name), documents)
+    elif os.path.basename(path).strip().lower().endswith(".txt"):
+        document = corpus_index.read_document(path)
+        documents.append({"id": document["id"], "text": document["text"]})
+    return documents
+
+
+def chunk_text(encoding, text, max_tokens=CHUNK_TOKENS):
+    """Returns `text` split into chunks of at most `max_tokens` tokens."""
+    tokens = encoding.encode(text)
+    return [encoding.decode(tokens[start : start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+
+def get_existing(store_path, column):
+    """Returns store at `store_path` (None if it does not exist) and set of values of its `column`."""
+    if not embedding_store.store_exists(store_path):
+        return None, set()
+    store = embedding_store.EmbeddingStore.load(store_path)
+    return store, set(store.metadata[column].tolist())
+
+
+def embed_and_append(store_path, store, texts, metadata, endpoint_params):
+    """Embeds `texts` and appends them with `metadata` rows to store at `store_path`, then updates its IVF index.
+
+    Returns status and response of the embedding request (response is None on success).
+    """
+    import pandas as pd
+
+    dimensions = store.dimensions if store is not None else EMBEDDING_DIMENSIONS
+    endpoint_params = {**endpoint_params, "dimensions": dimensions, "format": "float"}
+    status, response, _ = openai_api.request_embedding_endpoint(EMBEDDING_MODEL, texts, endpoint_params)
+    if status != 200:
+        return status, response
+    vectors = [e["embedding"] for e in sorted(response["data"], key=lambda x: x["index"])]
+    embedding_store.append_to_store(store_path, vectors, pd.DataFrame(metadata))
+    if os.path.isfile(f"{store_path}.ivf.npz"):
+        # assign only the new rows to their closest lists
+        ann_index.load_or_build_ivf_index(embedding_store.EmbeddingStore.load(store_path), store_path)
+    return status, None
+
+
+def ingest_documents(dataset_path, documents, endpoint_params):
+    """Embeds and appends `documents` (list of `{"id", "text"}` dicts) whose id is not already in the dataset.
+
+    Returns dict with numbers of documents added and skipped and chunks embedded, or the error of a failed request.
+    """
+    store_path = os.path.join(dataset_path, "documents")
+    with embedding_store.get_store_lock(store_path):  # one ingestion into a store at a time
+        store, existing = get_existing(store_path, "source")
+        new_documents = list({doc["id"]: doc for doc in documents if doc["id"] not in existing}.values())
+        result = {"added": len(new_documents), "skipped": len(documents) - len(new_documents), "chunks": 0}
+        if len(new_documents) == 0:
+            return result
+
+        encoding = openai_api.get_encoding(EMBEDDING_MODEL)
+        metadata = [
+            {"source": doc["id"], "text": chunk}
+            for doc in new_documents
+            for chunk in chunk_text(encoding, doc["text"], CHUNK_TOKENS)
+        ]
+        metadata = [row for row in metadata if row["text"].strip()]  # the endpoint rejects empty inputs
+        result["chunks"] = len(metadata)
+        print(f" * ingesting {len(new_documents)} documents ({len(metadata)} chunks) into {store_path}...")
+        status, response = embed_and_append(
+            store_path, store, [row["text"] for row in metadata], metadata, endpoint_params
+        )
+    if status != 200:
+        return {"status": status, "response": response}
+    return result
+
+
+def ingest_nodes(dataset_path, nodes, endpoint_params):
+    """Embeds and appends `nodes` (list of names) that are not already in the dataset.
+
+    Returns dict with numbers of nodes added and skipped, or the error of a failed request.
+    """
+    store_path = os.path.join(dataset_path, "nodes")
+    with embedding_store.get_store_lock(store_path):  # one ingestion into a store at a time
+        store, existing = get_existing(store_path, "node")
+        new_nodes = list(dict.fromkeys(node for node in nodes if node not in existing and node.strip()))
+        result = {"added": len(new_nodes), "skipped": len(nodes) - len(new_nodes)}
+        if len(new_nodes) == 0:
+            return result
+
+        print(f" * ingesting {len(new_nodes)} nodes into {store_path}...")
+        metadata = [{"node": node} for node in new_nodes]
+        status, response = embed_and_append(store_path, store, new_nodes, metadata, endpoint_params)
+    if status != 200:
+        return {"status": status, "response": response}
+    return result
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Add new documents and nodes to the embeddings of a dataset.")
+    parser.add_argument("dataset", help="dataset directory, e.g. data/embeddings/vast")
+    parser.add_argument("--documents", nargs="*", default=[], help=".txt files or directories of them")
+    parser.add_argument("--nodes", nargs="*", default=[], help="text files with one node name per line")
+    args = parser.parse_args()
+
+    load_dotenv()
+    endpoint_params = {"API_TOKEN": os.environ.get("OPENAI_API_KEY")}
+    if len(args.documents) > 0:
+        documents = []
+        for path in args.documents:
+            read_txt_files(path, documents)
+        print(f"documents: {ingest_documents(args.dataset, documents, endpoint_params)}")
+    if len(args.nodes) > 0:
+        nodes = []
+        for path in args.nodes:
+            with open(path, "r", encoding="utf-8") as f:
+                nodes.extend(line.strip() for line in f if line.strip())
+        print(f"nodes: {ingest_nodes(args.dataset, nodes, endpoint_params)}")
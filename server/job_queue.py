@@ -0,0 +1,263 @@
+"""Background job queue helper module.
+
+`JobQueue` runs long queries (e.g., summarizing a large pile with `gpt-4.1`) on a pool of worker threads instead of in
+the HTTP request, so clients submit a job, get its id right away, and poll or subscribe to it until it is done.
+
+Jobs and their results are persisted in SQLite, so they survive restarts: jobs that were queued or running when the
+server stopped are run again when it starts, and finished results can be fetched again without spending tokens on the
+same query twice.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+FINISHED = ["done", "failed", "cancelled"]  # statuses of jobs that will not change anymore
+
+
+class JobCancelled(Exception):
+    """Raised in a running job to stop it once it has been cancelled."""
+
+
+def hash_job_request(job_request):
+    """Returns content address of `job_request`, so identical requests can reuse the result of a finished job."""
+    return hashlib.sha256(json.dumps(job_request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """Queue of jobs run by `runner` on `max_workers` threads, persisted in SQLite at `path`.
+
+    `runner(job_request, on_delta, check_cancelled)` returns the results of a job, and calls `on_delta` with each piece
+    of text as it is generated, which is kept as the progress of the job and sent to subscribers. Both `on_delta` and
+    `check_cancelled` raise `JobCancelled` once the job is cancelled, so a running job stops at the next piece of text,
+    or wherever it checks, e.g. before each request to the OpenAI API.
+
+    Finished jobs beyond the newest `max_jobs` are deleted.
+    """
+
+    def __init__(self, path, runner, max_workers=2, max_jobs=1000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.runner = runner
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()  # one connection is shared between Flask request threads and workers
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                request_key TEXT NOT NULL,
+                request TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                generated TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_request_key ON jobs (request_key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+        self._conn.commit()
+        self._generated = {}  # id -> pieces of text generated so far by running jobs
+        self._cancelled = set()  # ids of running jobs that were cancelled
+        self._subscribers = {}  # id -> list of queues of events of the job
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+        # run jobs that were interrupted by a restart again
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+            self._conn.commit()
+            ids = [x for (x,) in self._conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created")]
+        for job_id in ids:
+            self._executor.submit(self._run, job_id)
+        if len(ids) > 0:
+            print(f" * resumed {len(ids)} queued jobs")
+
+    def submit(self, job_request, reuse=True):
+        """Queues a job for `job_request` and returns its id, and whether it is a finished job with the same request.
+
+        If `reuse` is set, returns the newest job with an identical request that is done or still in progress instead.
+        """
+        request_key = hash_job_request(job_request)
+        with self._lock:
+            if reuse:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE request_key = ? AND status IN ('queued', 'running', 'done') "
+                    "ORDER BY created DESC LIMIT 1",
+                    (request_key,),
+                ).fetchone()
+                if row is not None:
+                    return row[0], True
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, request_key, request, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, request_key, json.dumps(job_request), time.time()),
+            )
+            self._prune()
+            self._conn.commit()
+        self._executor.submit(self._run, job_id)
+        return job_id, False
+
+    def _prune(self):
+        """Deletes finished jobs beyond the newest `max_jobs`, must hold `_lock`."""
+        self._conn.execute(
+            f"""
+            DELETE FROM jobs WHERE status IN ({",".join("?" * len(FINISHED))}) AND id NOT IN (
+                SELECT id FROM jobs ORDER BY created DESC LIMIT ?
+            )
+            """,
+            (*FINISHED, self.max_jobs),
+        )
+
+    def _publish(self, job_id, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(job_id, []))
+        for events in subscribers:
+            events.put((event, data))
+
+    def _run(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT request, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[1] != "queued":
+                return  # cancelled or deleted while queued
+            self._conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job_id))
+            self._conn.commit()
+            self._generated[job_id] = []
+        self._publish(job_id, "status", self.get(job_id, include_result=False))
+
+        def check_cancelled():
+            with self._lock:
+                if job_id in self._cancelled:
+                    raise JobCancelled()
+
+        def on_delta(text):
+            with self._lock:
+                if job_id in self._cancelled:
+                    raise JobCancelled()
+                self._generated[job_id].append(text)
+            self._publish(job_id, "delta", {"text": text})
+
+        result, error = None, None
+        try:
+            result = self.runner(json.loads(row[0]), on_delta, check_cancelled)
+            status = "done" if result.get("success", False) else "failed"
+        except JobCancelled:
+            status = "cancelled"
+        except Exception as e:
+            print(f"job {job_id} failed: {e}")
+            status, error = "failed", str(e)
+        with self._lock:
+            if job_id in self._cancelled:
+                status, result = "cancelled", None  # cancelled after its last piece of text, discard the result
+            generated = "".join(self._generated.pop(job_id, []))
+            self._cancelled.discard(job_id)
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, generated = ?, finished = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, generated, time.time(), job_id),
+            )
+            self._conn.commit()
+        self._publish(job_id, "status", self.get(job_id))
+
+    def cancel(self, job_id):
+        """Cancels job `job_id` if it is not finished yet, returns False if the job is unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            if row[0] == "queued":
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (time.time(), job_id)
+                )
+                self._conn.commit()
+            elif row[0] == "running":
+                self._cancelled.add(job_id)  # the job stops at its next piece of text, or discards its result
+                return True
+            else:
+                return True
+        self._publish(job_id, "status", self.get(job_id))
+        return True
+
+    def get(self, job_id, include_result=True):
+        """Returns dict of job `job_id` with its status, progress and (once finished) results, or None if unknown."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, request, status, result, error, generated, created, started, finished FROM jobs "
+                "WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            generated = "".join(self._generated.get(job_id, [])) if row is not None and row[2] == "running" else None
+            cancelling = job_id in self._cancelled
+        if row is None:
+            return None
+        job_request = json.loads(row[1])
+        job = {
+            "id": row[0],
+            "task": job_request.get("task"),
+            "status": row[2],
+            "cancelling": cancelling,
+            "created": row[6],
+            "started": row[7],
+            "finished": row[8],
+            "generated": generated if generated is not None else row[5],  # text generated so far
+        }
+        if row[4] is not None:
+            job["error"] = row[4]
+        if include_result and row[3] is not None:
+            job["result"] = json.loads(row[3])
+        return job
+
+    def list_jobs(self, status=None, limit=100):
+        """Returns list of newest `limit` jobs, optionally with `status`, without their results."""
+        with self._lock:
+            if status is None:
+                ids = self._conn.execute("SELECT id FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                ids = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY created DESC LIMIT ?", (status, limit)
+                ).fetchall()
+        jobs = [self.get(job_id, include_result=False) for (job_id,) in ids]
+        return [job for job in jobs if job is not None]
+
+    def subscribe(self, job_id):
+        """Yields `(event, data)` of job `job_id` until it is finished, starting with its current state.
+
+        Events are `status` with the job (see `get`) and `delta` with each piece of text generated after subscribing.
+        """
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append(events)
+        try:
+            job = self.get(job_id)
+            yield "status", job
+            while job is not None and job["status"] not in FINISHED:
+                event, data = events.get()
+                yield event, data
+                if event == "status" and data is not None and data["status"] in FINISHED:
+                    break
+        finally:
+            with self._lock:
+                self._subscribers[job_id].remove(events)
+                if len(self._subscribers[job_id]) == 0:
+                    del self._subscribers[job_id]
+
+    def stats(self):
+        """Returns dict of number of jobs by status."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
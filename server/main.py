@@ -6,16 +6,28 @@ Runs queries to LLMs using documents and instructions provided by the interface.
 Sends results of LLM queries back to the frontend using Flask server.
 """
 
-import fnmatch
 import json
 import os
-from ast import literal_eval
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from dotenv import load_dotenv
-import pandas as pd
 
+import corpus_index
+import dataset_registry
+import http_client
+import ingest
+import job_queue
+import openai_api
+import openai_cache
 import openai_tasks
+import rate_limiter
+import sentence_segmenter
+import token_cache
+import usage_log
 
 
 __author__ = "Adam Coscia"
@@ -29,112 +41,244 @@ load_dotenv()
 
 API_TOKEN = os.environ.get("OPENAI_API_KEY")  # gives access to OpenAI API
 OPENAI_EMBEDDING_MODEL = "text-embedding-3-large"  # OpenAI embedding model
+SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "exact")  # "exact" scans every row, "ivf" is approximate and faster
+SEARCH_NPROBE = int(os.environ.get("SEARCH_NPROBE", 8))  # lists scanned per query by "ivf", higher is more accurate
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 50000))  # 0 disables the cache
+CHAT_CACHE_TTL = int(os.environ.get("CHAT_CACHE_TTL", 0))  # seconds to reuse chat responses, 0 disables the cache
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get("CHAT_CACHE_MAX_ENTRIES", 1000))
+TOKEN_CACHE_MAX_TOKENS = int(os.environ.get("TOKEN_CACHE_MAX_TOKENS", 50_000_000))  # tokens of documents in memory
+TOKEN_CACHE_SPILL = os.environ.get("TOKEN_CACHE_SPILL", "0") == "1"  # spill evicted tokens to disk instead of dropping
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")  # change to test against a stub
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 10))  # seconds to connect to the API
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", 300))  # seconds to wait for the API to respond
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 4))  # retries for 429 / 5xx responses and timeouts
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 8))  # max in-flight requests per model
+OPENAI_MODEL_CONCURRENCY = os.environ.get("OPENAI_MODEL_CONCURRENCY", "")  # per model overrides, e.g. "gpt-4.1=4"
+OPENAI_RATE_LIMITS = os.environ.get("OPENAI_RATE_LIMITS", "")  # RPM:TPM of models, e.g. "gpt-4.1=500:30000"
+SENTENCE_SEGMENTER = os.environ.get("SENTENCE_SEGMENTER", "senter")  # "senter", "parser" or "sentencizer"
+SENTENCE_BATCH_SIZE = int(os.environ.get("SENTENCE_BATCH_SIZE", 64))  # texts segmented together by spaCy
+SENTENCE_N_PROCESS = int(os.environ.get("SENTENCE_N_PROCESS", 1))  # processes to segment large piles with
+SENTENCE_CACHE_MAX_ENTRIES = int(os.environ.get("SENTENCE_CACHE_MAX_ENTRIES", 10000))  # texts to keep sentences of
+COMPARE_MAX_MEMORY_MB = int(os.environ.get("COMPARE_MAX_MEMORY_MB", 256))  # similarity scores held by a comparison
+COMPARE_MAX_WORKERS = int(os.environ.get("COMPARE_MAX_WORKERS", os.cpu_count() or 1))  # threads per comparison
+SUMMARY_EVALUATION = os.environ.get("SUMMARY_EVALUATION", "sync")  # score summaries "sync", "async" or "off"
+DOCUMENTS_REFRESH_SECONDS = float(os.environ.get("DOCUMENTS_REFRESH_SECONDS", 5))  # rescan articles at most this often
+DATASETS = os.environ.get("DATASETS", "")  # extra datasets by name, e.g. "other=data/embeddings/other"
+DEFAULT_DATASET = os.environ.get("DEFAULT_DATASET", "live")  # dataset loaded at startup, "live" is VAST
+DATASET_MAX_MEMORY_MB = int(os.environ.get("DATASET_MAX_MEMORY_MB", 0))  # unload datasets over this, 0 for no limit
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "0") == "1"  # load embeddings, spaCy, ROUGE and tokenizers on first use
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1") == "1"  # share responses of identical requests in flight
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", 5))  # write token usage to disk at most this often
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", 2))  # jobs submitted to `/jobs` run at once
+BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", 8))  # jobs of a `/query/batch` request run at once
+SERVER = os.environ.get("SERVER", "flask")  # "flask" development server or "waitress" for concurrent serving
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 64))  # requests handled at once by "waitress"
+
+# share pooled keep-alive connections to the OpenAI API between all requests
+openai_api.OPENAI_BASE_URL = OPENAI_BASE_URL
+openai_api.HTTP_CLIENT = http_client.HTTPClient(
+    pool_maxsize=max(SERVER_THREADS, OPENAI_MAX_CONCURRENCY),  # a keep-alive connection for every request thread
+    connect_timeout=OPENAI_CONNECT_TIMEOUT,
+    read_timeout=OPENAI_READ_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+)
+
+# limit number of requests in flight to each model, requests over the limit wait for a free slot
+openai_api.MAX_CONCURRENCY_PER_MODEL = OPENAI_MAX_CONCURRENCY
+for model_limit in filter(None, OPENAI_MODEL_CONCURRENCY.split(",")):
+    model, limit = model_limit.split("=")
+    openai_api.MODEL_CONCURRENCY[model.strip()] = int(limit)
+
+# hold requests over the requests / tokens per minute of a model until they are within its limits, instead of 429s
+rate_limits = {}
+for model_limits in filter(None, OPENAI_RATE_LIMITS.split(",")):
+    model, limits = model_limits.split("=")
+    rpm, tpm = limits.split(":")
+    rate_limits[model.strip()] = (int(rpm) if rpm.strip() else None, int(tpm) if tpm.strip() else None)
+openai_api.RATE_LIMITER = rate_limiter.RateLimiter(rate_limits)
+
+# cache embeddings of queries and sentences, so identical inputs are only sent to the OpenAI API once
+if EMBEDDING_CACHE_MAX_ENTRIES > 0:
+    openai_api.EMBEDDING_CACHE = openai_cache.EmbeddingCache(
+        os.path.join(".", "data", "cache", "embeddings.sqlite"), EMBEDDING_CACHE_MAX_ENTRIES
+    )
+
+# tokenize each document once and reuse its tokens in every prompt it is formatted into
+openai_api.TOKEN_CACHE = token_cache.TokenCache(
+    TOKEN_CACHE_MAX_TOKENS, os.path.join(".", "data", "cache", "tokens.sqlite") if TOKEN_CACHE_SPILL else None
+)
+
+# split texts into sentences with only the spaCy components needed, and keep the sentences of recent documents
+openai_tasks.SENTENCE_SEGMENTER = sentence_segmenter.SentenceSegmenter(
+    "data/models/en_core_web_sm-3.8.0",
+    SENTENCE_SEGMENTER,
+    batch_size=SENTENCE_BATCH_SIZE,
+    n_process=SENTENCE_N_PROCESS,
+    max_entries=SENTENCE_CACHE_MAX_ENTRIES,
+)
+
+# score sentence comparisons in tiles, so comparing a long report to a large pile does not run out of memory
+openai_tasks.COMPARE_MAX_MEMORY = COMPARE_MAX_MEMORY_MB * 2**20
+openai_tasks.COMPARE_MAX_WORKERS = COMPARE_MAX_WORKERS
+
+# score summaries with a ROUGE metric loaded once
+openai_tasks.SUMMARY_EVALUATION = SUMMARY_EVALUATION
+
+# keep articles served by `/documents` in memory, only reading new and changed files again
+CORPUS_INDEX = corpus_index.CorpusIndex(os.path.join(".", "data", "News Articles"), DOCUMENTS_REFRESH_SECONDS)
+
+# count tokens used in memory and write them to an append-only log in the background, off the request path
+openai_api.USAGE_LOG = usage_log.UsageLog(os.path.join(".", "data", "usage"), USAGE_FLUSH_SECONDS)
+
+# identical chat and embedding requests sent at the same moment (e.g., a query fired twice) wait on a single request
+if not COALESCE_REQUESTS:
+    openai_api.CHAT_SINGLE_FLIGHT = None
+    openai_api.EMBEDDING_SINGLE_FLIGHT = None
+
+# reuse responses to identical chat requests (same messages, model and sampling params), opt-in with CHAT_CACHE_TTL
+if CHAT_CACHE_TTL > 0:
+    openai_api.CHAT_CACHE = openai_cache.ChatCache(CHAT_CACHE_TTL, CHAT_CACHE_MAX_ENTRIES)
 
 #
-# load chunked text and pre-computed embeddings
-# the files are ~100 MB combined, so may take a minute
-# embeddings are of length 1024
-# must convert embeddings from CSV str type back to list type
-# the doc dataframe has three columns: "source", "text" and "embedding"
-# the node dataframe has two columns: "node" and "embedding"
+# register datasets of pre-computed embeddings, each loaded the first time a query uses it
+# embeddings are of length 1024 and are memory-mapped from a float32 `.npy` store
+# the store is built from the CSV files the first time the dataset is loaded (see `embedding_store.py`)
+# the doc store has metadata columns "source" and "text"
+# the node store has metadata column "node"
+# "live" is the VAST dataset, every other directory in `data/embeddings` is a dataset named after the directory
 #
-print(" * loading document embeddings...")
-VAST_DOCUMENT_EMBEDDINGS = pd.read_csv("data/embeddings/vast/documents.csv")
-VAST_DOCUMENT_EMBEDDINGS["embedding"] = VAST_DOCUMENT_EMBEDDINGS["embedding"].apply(literal_eval)
-
-print(" * loading node embeddings...")
-VAST_NODE_EMBEDDINGS = pd.read_csv("data/embeddings/vast/nodes.csv")
-VAST_NODE_EMBEDDINGS["embedding"] = VAST_NODE_EMBEDDINGS["embedding"].apply(literal_eval)
-
-print(" * embeddings loaded!")
-
-
-def os_path_to_list(path, d, root):
-    """Traverse files and their content nested in local directory.
-
-    Returns flat list of file dicts with paths and contents.
-    """
-    name = os.path.basename(path)
-    if os.path.isdir(path):
-        # path is a directory
-        for x in os.listdir(path):
-            os_path_to_list(os.path.join(path, x), d, root)
-    else:
-        # path is a file
-        if name.strip().lower().endswith(".txt"):
-            with open(path, "r", encoding="cp1252", errors="backslashreplace") as f:
-                new_id = path.replace(os.sep, "/")  # normalize path
-                new_path = path.replace(root + os.sep, "").replace(os.sep, "/")  # normalize path
-                d.append(
-                    {
-                        "id": new_id,
-                        "path": new_path,
-                        "pathList": new_path.split("/"),
-                        "name": name,
-                        "text": f.read(),
-                    }
-                )
-    return d
-
-
-def query(model_checkpoint, model_type, user_model_params, dataset, task, user_task_settings, documents):
+EMBEDDING_DATASETS = dataset_registry.DatasetRegistry(
+    DATASET_MAX_MEMORY_MB * 2**20 if DATASET_MAX_MEMORY_MB > 0 else None, SEARCH_INDEX, SEARCH_NPROBE
+)
+EMBEDDING_DATASETS.register("live", "data/embeddings/vast")
+for name_path in filter(None, DATASETS.split(",")):
+    name, path = name_path.split("=")
+    EMBEDDING_DATASETS.register(name.strip(), path.strip())
+EMBEDDING_DATASETS.discover("data/embeddings")
+ingest.EMBEDDING_MODEL = OPENAI_EMBEDDING_MODEL
+
+
+def load_tokenizers():
+    """Loads tokenizers of the embedding model and chat models."""
+    for model_checkpoint in [OPENAI_EMBEDDING_MODEL, "gpt-4.1", "gpt-3.5-turbo"]:
+        openai_api.get_encoding(model_checkpoint)
+
+
+# components loaded at startup (or on first use with LAZY_STARTUP), with functions to load them and check if loaded
+WARMUP_COMPONENTS = {
+    "embeddings": (
+        lambda: EMBEDDING_DATASETS.get(DEFAULT_DATASET),
+        lambda: EMBEDDING_DATASETS.is_loaded(DEFAULT_DATASET),
+    ),
+    "tokenizers": (load_tokenizers, lambda: openai_api.get_encoding.cache_info().currsize > 0),
+    "sentences": (lambda: openai_tasks.SENTENCE_SEGMENTER.nlp, lambda: openai_tasks.SENTENCE_SEGMENTER.loaded),
+    "rouge": (openai_tasks.SUMMARY_EVALUATOR.load, lambda: openai_tasks.SUMMARY_EVALUATOR.loaded),
+}
+READY_COMPONENTS = [] if LAZY_STARTUP else [x for x in WARMUP_COMPONENTS if x != "rouge" or SUMMARY_EVALUATION != "off"]
+
+
+def warm_up(components):
+    """Loads `components` of `WARMUP_COMPONENTS` if not loaded yet, and returns seconds spent on each."""
+    seconds = {}
+    for name in components:
+        load, _ = WARMUP_COMPONENTS[name]
+        start = time.perf_counter()
+        load()
+        seconds[name] = time.perf_counter() - start
+    return seconds
+
+
+if not LAZY_STARTUP:
+    # load embeddings before serving, and the rest in the background (see `/readyz`)
+    EMBEDDING_DATASETS.get(DEFAULT_DATASET)
+    background_components = [name for name in READY_COMPONENTS if name != "embeddings"]
+    threading.Thread(target=warm_up, args=(background_components,), daemon=True).start()
+
+
+# tasks that use the OpenAI chat endpoint API
+OPENAI_CHAT_TASKS = [
+    "analyze",
+    "summarize",
+    "extract_entities",
+    "classify_topics",
+    "generate_questions",
+    "generate_tasks",
+    "explain_concepts",
+    "answer_questions",
+    "custom",
+]
+# tasks that use the OpenAI embedding endpoint API
+OPENAI_EMBEDDING_TASKS = ["search_nodes", "search_documents", "compare_sentences"]
+
+
+def get_openai_endpoint_parameters(task, user_model_params):
+    """Returns OpenAI endpoint parameters of `task`, overridden by `user_model_params` from the frontend."""
+    if task in OPENAI_CHAT_TASKS:
+        # chat endpoint parameters
+        endpoint_parameters = {
+            "API_TOKEN": API_TOKEN,  # gives access to OpenAI API
+            "frequency_penalty": 1,  # [-2, 2] positive means less repetition in words
+            "presence_penalty": 1,  # [-2, 2] positive penalize model for talking about new things
+            "temperature": 0.2,  # [0, 2] set this or top_p but not both, lower to reduce randomness
+            "top_p": None,  # [0, 1] set this or top_p but not both, lower to reduce randomness
+        }
+    if task in OPENAI_EMBEDDING_TASKS:
+        # embedding endpoint parameters
+        endpoint_parameters = {
+            "API_TOKEN": API_TOKEN,  # gives access to OpenAI API
+            "dimensions": 1024,  # Number of dimensions the resulting output embeddings should have. None for default.
+            "format": "float",  # Format for embeddings, either `float` or `base64`
+        }
+    # override endpoint parameters with user model parameters from frontend
+    if user_model_params is not None:
+        for key, value in user_model_params.items():
+            endpoint_parameters[key] = value
+    return endpoint_parameters
+
+
+def query(
+    model_checkpoint,
+    model_type,
+    user_model_params,
+    dataset,
+    task,
+    user_task_settings,
+    documents,
+    priority="interactive",
+):
     """Queries `model_checkpoint` using protocol for `model_type` and `task`.
 
     Uses `documents` and additional `user_model_params` and `user_task_settings` provided by the frontend interface.
-    """
-    # tasks that use the OpenAI chat endpoint API
-    openai_chat_tasks = [
-        "analyze",
-        "summarize",
-        "extract_entities",
-        "classify_topics",
-        "generate_questions",
-        "generate_tasks",
-        "explain_concepts",
-        "answer_questions",
-        "custom",
-    ]
-    # tasks that use the OpenAI embedding endpoint API
-    openai_embedding_tasks = ["search_nodes", "search_documents", "compare_sentences"]
 
+    Requests to the OpenAI API are rate limited with `priority` "interactive" or "background", see `OPENAI_RATE_LIMITS`.
+    """
     if model_type == "openai":
         # set endpoint parameters
-        if task in openai_chat_tasks:
-            # chat endpoint parameters
-            endpoint_parameters = {
-                "API_TOKEN": API_TOKEN,  # gives access to OpenAI API
-                "frequency_penalty": 1,  # [-2, 2] positive means less repetition in words
-                "presence_penalty": 1,  # [-2, 2] positive penalize model for talking about new things
-                "temperature": 0.2,  # [0, 2] set this or top_p but not both, lower to reduce randomness
-                "top_p": None,  # [0, 1] set this or top_p but not both, lower to reduce randomness
-            }
-        if task in openai_embedding_tasks:
-            # embedding endpoint parameters
-            endpoint_parameters = {
-                "API_TOKEN": API_TOKEN,  # gives access to OpenAI API
-                "dimensions": 1024,  # Number of dimensions the resulting output embeddings should have. None for default.
-                "format": "float",  # Format for embeddings, either `float` or `base64`
-            }
-        # override endpoint parameters with user model parameters from frontend
-        if user_model_params is not None:
-            for key, value in user_model_params.items():
-                endpoint_parameters[key] = value
+        endpoint_parameters = get_openai_endpoint_parameters(task, user_model_params)
 
     # pick sub-routine based on model type and task
     results = {}
+    openai_api.USAGE_TASK.set(task)  # count tokens used by requests of this query for `task`
+    openai_api.REQUEST_PRIORITY.set(priority)
 
-    if task in openai_chat_tasks:
+    if task in OPENAI_CHAT_TASKS:
         openai_chat_args = [model_checkpoint, endpoint_parameters, user_task_settings, documents, results]
-    if task in openai_embedding_tasks:
+    if task in OPENAI_EMBEDDING_TASKS:
         # data to compare with query
-        if dataset == "live":
-            # VAST dataset embeddings
-            if task == "search_nodes":
-                data = VAST_NODE_EMBEDDINGS
-            if task == "search_documents":
-                data = VAST_DOCUMENT_EMBEDDINGS
-            if task == "compare_sentences":
-                data = documents
+        if task in ["search_nodes", "search_documents"]:
+            # embeddings of `dataset`, loaded if this is the first query using it
+            store_name = "nodes" if task == "search_nodes" else "documents"
+            try:
+                data = EMBEDDING_DATASETS.get(dataset).indexes[store_name]
+            except KeyError:
+                results["success"] = False
+                results["status"] = 404
+                results["response"] = {
+                    "error": {"message": f"dataset {dataset} has no {store_name} embeddings", "type": "unknown_dataset"}
+                }
+                return results
+        if task == "compare_sentences":
+            data = documents
         openai_embedding_args = [OPENAI_EMBEDDING_MODEL, endpoint_parameters, user_task_settings, data, results]
 
     if model_type == "openai":
@@ -166,10 +310,56 @@ def query(model_checkpoint, model_type, user_model_params, dataset, task, user_t
     return results
 
 
+def run_job(job_request, on_delta, check_cancelled):
+    """Runs `/jobs` request `job_request` like a `/query` with background priority, streaming text to `on_delta`.
+
+    `check_cancelled` is called before each request to the OpenAI API, including those sent from worker threads (e.g.
+    map-reduce chunks and embedding batches), so a cancelled job stops sending requests.
+    """
+    openai_tasks.STREAM_CALLBACK.set(on_delta)
+    openai_api.CANCEL_CHECK.set(check_cancelled)
+    return query(
+        job_request["model_checkpoint"],
+        job_request["model_type"],
+        job_request["model_settings"],
+        job_request["dataset"],
+        job_request["task"],
+        job_request["task_settings"],
+        job_request["documents"],
+        priority="background",
+    )
+
+
+# run long queries in the background, persisting jobs and results so they survive restarts
+JOB_QUEUE = job_queue.JobQueue(os.path.join(".", "data", "jobs", "jobs.sqlite"), run_job, JOB_MAX_WORKERS)
+
+
+def prepare_batch(jobs):
+    """Tokenizes the documents, segments the sentences and embeds the inputs shared by `jobs` of a batch once."""
+    chat_documents = {}  # model checkpoint -> documents
+    embedding_groups = {}  # endpoint params -> (endpoint params, texts to segment, inputs to embed)
+    for job in jobs:
+        task, task_settings = job["task"], job["task_settings"]
+        if job["model_type"] != "openai":
+            continue
+        if task in OPENAI_CHAT_TASKS:
+            chat_documents.setdefault(job["model_checkpoint"], []).extend(job["documents"])
+        if task in OPENAI_EMBEDDING_TASKS:
+            endpoint_parameters = get_openai_endpoint_parameters(task, job["model_settings"])
+            key = json.dumps(endpoint_parameters, sort_keys=True)
+            _, texts, inputs = embedding_groups.setdefault(key, (endpoint_parameters, [], []))
+            if task == "compare_sentences":
+                texts.extend(source["text"] for source in [task_settings["query"], *job["documents"]])
+            else:
+                query_text = task_settings["query"]
+                inputs.extend([query_text] if isinstance(query_text, str) else query_text)
+    openai_tasks.prepare_batch(chat_documents, list(embedding_groups.values()), OPENAI_EMBEDDING_MODEL)
+
+
 #
 # Web app packages
 #
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
 
@@ -184,27 +374,169 @@ def get_connected():
     return jsonify("Connected!")
 
 
+@app.route("/healthz", methods=["GET"])
+def get_liveness():
+    """Liveness probe, responds as long as the server is running."""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def get_readiness():
+    """Readiness probe, responds with 503 until the components loaded at startup are loaded (none with LAZY_STARTUP)."""
+    loaded = {name: is_loaded() for name, (_, is_loaded) in WARMUP_COMPONENTS.items()}
+    ready = all(loaded[name] for name in READY_COMPONENTS)
+    return jsonify({"ready": ready, "lazy_startup": LAZY_STARTUP, "loaded": loaded}), 200 if ready else 503
+
+
+@app.route("/warmup", methods=["POST"])
+def post_warmup():
+    """Loads components ahead of their first use, all of them unless a list of `components` is sent."""
+    data_in = request.get_json(silent=True) or {}
+    components = data_in.get("components", list(WARMUP_COMPONENTS))
+    unknown = [name for name in components if name not in WARMUP_COMPONENTS]
+    if len(unknown) > 0:
+        return jsonify({"error": f"unknown components: {unknown}"}), 400
+    seconds = warm_up(components)
+    loaded = {name: is_loaded() for name, (_, is_loaded) in WARMUP_COMPONENTS.items()}
+    return jsonify({"seconds": seconds, "loaded": loaded})
+
+
 @app.route("/token-usage", methods=["GET"])
 def get_token_usage():
-    """Displays token usage info."""
-    tokens_used = {}
-    for file in os.listdir(os.path.join(".", "data", "usage")):
-        if fnmatch.fnmatch(file, "tokens_used*.json"):
-            fp = os.path.join(".", "data", "usage", file)
-            with open(fp, "r") as f:
-                counts = json.load(f)
-                tokens_used[file] = counts
-    return jsonify(tokens_used)
+    """Displays requests and input / output / total tokens used, in total, by model, by task and by model and task.
+
+    Optional query parameters:
+
+    - `window`: only count usage in the last `window` seconds, e.g. `3600` for the last hour
+    - `interval`: also count usage in consecutive `interval` seconds in `series`, e.g. `86400` for each day
+    - `model` / `task`: only count usage of a model or task
+    """
+    usage = openai_api.USAGE_LOG.aggregate(
+        window=request.args.get("window", None, type=float),
+        interval=request.args.get("interval", None, type=int),
+        model=request.args.get("model", None),
+        task=request.args.get("task", None),
+    )
+    return jsonify(usage)
+
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Displays hit / miss counts and sizes of response caches, and counts of coalesced requests."""
+    cache_stats = {}
+    if openai_api.EMBEDDING_CACHE is not None:
+        cache_stats["embeddings"] = openai_api.EMBEDDING_CACHE.stats()
+    if openai_api.CHAT_CACHE is not None:
+        cache_stats["chat"] = openai_api.CHAT_CACHE.stats()
+    if openai_api.TOKEN_CACHE is not None:
+        cache_stats["tokens"] = openai_api.TOKEN_CACHE.stats()
+    cache_stats["sentences"] = openai_tasks.SENTENCE_SEGMENTER.stats()
+    if openai_api.CHAT_SINGLE_FLIGHT is not None:
+        cache_stats["coalesced_chat"] = openai_api.CHAT_SINGLE_FLIGHT.stats()
+    if openai_api.EMBEDDING_SINGLE_FLIGHT is not None:
+        cache_stats["coalesced_embeddings"] = openai_api.EMBEDDING_SINGLE_FLIGHT.stats()
+    return jsonify(cache_stats)
+
+
+@app.route("/rate-limits", methods=["GET"])
+def get_rate_limits():
+    """Displays rate limits of each model with limits, tokens and requests available, and waiting requests."""
+    return jsonify(openai_api.RATE_LIMITER.stats())
+
+
+@app.route("/datasets", methods=["GET"])
+def get_datasets():
+    """Displays registered embedding datasets, which of them are loaded and the memory they use."""
+    return jsonify(EMBEDDING_DATASETS.stats())
+
+
+@app.route("/ingest", methods=["POST"])
+def post_ingest():
+    """Adds new documents and nodes to the embeddings of a dataset without re-embedding existing ones (see `ingest.py`).
+
+    Accepts a `dataset` name, and any of `paths` of `.txt` files or directories in `data/News Articles`, `documents` as
+    a list of `{"id", "text"}` dicts and `nodes` as a list of names.
+    """
+    data_in = request.json  # request is sent as JSON, which is converted to a dict
+
+    dataset = data_in.get("dataset", DEFAULT_DATASET)
+    if dataset not in EMBEDDING_DATASETS.paths:
+        return jsonify({"success": False, "error": f"unknown dataset: {dataset}"}), 404
+
+    # check inputs before anything is embedded, rows appended to a store cannot be taken back
+    documents = data_in.get("documents", [])
+    if not isinstance(documents, list) or not all(
+        isinstance(doc, dict) and isinstance(doc.get("id"), str) and isinstance(doc.get("text"), str)
+        for doc in documents
+    ):
+        return jsonify({"success": False, "error": 'documents must be a list of {"id", "text"} strings'}), 400
+    nodes = data_in.get("nodes", [])
+    if not isinstance(nodes, list) or not all(isinstance(node, str) for node in nodes):
+        return jsonify({"success": False, "error": "nodes must be a list of strings"}), 400
+    paths = data_in.get("paths", [])
+    if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+        return jsonify({"success": False, "error": "paths must be a list of strings"}), 400
+
+    # only read files the `/documents` endpoint would also serve
+    root = os.path.join(".", "data", "News Articles")
+    documents = [{"id": doc["id"], "text": doc["text"]} for doc in documents]
+    for path in paths:
+        if os.path.commonpath([os.path.realpath(root), os.path.realpath(path)]) != os.path.realpath(root):
+            return jsonify({"success": False, "error": f"path is not in {root}: {path}"}), 400
+        ingest.read_txt_files(path, documents)
+
+    endpoint_parameters = {"API_TOKEN": API_TOKEN}
+    openai_api.USAGE_TASK.set("ingest")
+    openai_api.REQUEST_PRIORITY.set("background")  # interactive queries are sent first when over the rate limits
+    dataset_path = EMBEDDING_DATASETS.paths[dataset]
+    results = {}
+    if len(documents) > 0:
+        results["documents"] = ingest.ingest_documents(dataset_path, documents, endpoint_parameters)
+    if len(nodes) > 0:
+        results["nodes"] = ingest.ingest_nodes(dataset_path, nodes, endpoint_parameters)
+    results["success"] = all("status" not in result for result in results.values())
+
+    EMBEDDING_DATASETS.unload(dataset)  # the next query loads the dataset with the new rows
+    return jsonify(results)
+
+
+@app.route("/summary-evaluations/<evaluation_id>", methods=["GET"])
+def get_summary_evaluation(evaluation_id):
+    """Displays ROUGE scores of a summary evaluated in the background, see `evaluation_id` in summary stats."""
+    evaluation = openai_tasks.SUMMARY_EVALUATOR.get(evaluation_id)
+    if evaluation is None:
+        return jsonify({"error": f"unknown evaluation id: {evaluation_id}"}), 404
+    return jsonify(evaluation)
 
 
 @app.route("/documents", methods=["GET"])
 def get_documents():
-    """Get files from local directory to use as documents."""
-    root = os.path.join(".", "data", "News Articles")
+    """Get files from local directory to use as documents.
+
+    Optional query parameters:
+
+    - `offset` / `limit`: page of documents to send, all of them by default (`X-Total-Count` header has the total)
+    - `fields`: comma-separated fields of each document to send, e.g. `id,path,name` for metadata without the text
+
+    Supports conditional requests with `If-None-Match`, and gzip compression.
+    """
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", None, type=int)
+    fields = request.args.get("fields", None)
+    if fields is not None:
+        fields = [field for field in fields.split(",") if field in corpus_index.DOCUMENT_FIELDS]
 
-    files = os_path_to_list(root, [], root)
+    etag, total, body, gzipped_body = CORPUS_INDEX.get_page(offset, limit, fields)
 
-    return jsonify(files)
+    use_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+    response = Response(gzipped_body if use_gzip else body, mimetype="application/json")
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["X-Total-Count"] = str(total)
+    response.headers["Access-Control-Expose-Headers"] = "ETag, X-Total-Count"
+    response.set_etag(f"{etag}-gzip" if use_gzip else etag)
+    return response.make_conditional(request)
 
 
 @app.route("/save", methods=["POST"])
@@ -239,5 +571,211 @@ def post_query():
     return jsonify(data_out)  # send data to client (must be in JSON string format)
 
 
+@app.route("/query/stream", methods=["POST"])
+def post_query_stream():
+    """Query model like `/query`, but stream the response as server-sent events while it is generated.
+
+    Sends a `delta` event with `{"text": "..."}` for each piece of generated text of chat tasks, then a single `result`
+    event with the same results `/query` returns (e.g., ROUGE scores of summaries are computed after the stream closes).
+
+    If `stream_links` is set in the `task_settings` of `compare_sentences`, sends a `links` event with the `links` of
+    each block of query sentences as it is computed, and leaves the links out of the `result` event.
+    """
+    data_in = request.json  # request is sent as JSON, which is converted to a dict
+
+    query_args = [
+        data_in["model_checkpoint"],
+        data_in["model_type"],
+        data_in["model_settings"],
+        data_in["dataset"],
+        data_in["task"],
+        data_in["task_settings"],
+        data_in["documents"],
+    ]
+    events = queue.Queue()
+
+    def run_query():
+        # run query in a separate thread, so events can be sent to the client while the model generates text
+        openai_tasks.STREAM_CALLBACK.set(lambda text: events.put(("delta", {"text": text})))
+        openai_tasks.LINKS_CALLBACK.set(lambda links: events.put(("links", {"links": links})))
+        try:
+            events.put(("result", query(*query_args)))
+        except Exception as e:
+            events.put(("result", {"success": False, "response": {"error": {"message": str(e)}}, "status": 500}))
+            raise
+
+    def generate_events():
+        while True:
+            event, data = events.get()
+            yield f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+            if event == "result":
+                break
+
+    threading.Thread(target=run_query, daemon=True).start()
+
+    return Response(
+        generate_events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # don't let proxies buffer events
+    )
+
+
+@app.route("/query/batch", methods=["POST"])
+def post_query_batch():
+    """Query model with many jobs at once, and stream the result of each job as server-sent events as it completes.
+
+    Accepts a list of `jobs`, each with the `task`, `task_settings` and `documents` of a `/query`, and optionally an
+    `id`. Jobs use the `model_checkpoint`, `model_type`, `model_settings` and `dataset` of the batch unless they set
+    their own.
+
+    Tokenization, sentence segmentation and embeddings shared by the jobs are done once, then up to `BATCH_MAX_WORKERS`
+    jobs run at once under the same rate limits as `/query`. Sends a `result` event with the `index`, `id` and `result`
+    of each job in the order they complete, then a single `done` event.
+    """
+    data_in = request.json  # request is sent as JSON, which is converted to a dict
+
+    if not isinstance(data_in.get("jobs"), list) or not all(isinstance(job, dict) for job in data_in["jobs"]):
+        return jsonify({"error": "jobs must be a list of objects"}), 400
+    defaults = {
+        key: data_in[key] for key in ["model_checkpoint", "model_type", "model_settings", "dataset"] if key in data_in
+    }
+    jobs = [{**defaults, **job} for job in data_in["jobs"]]
+    keys = ["model_checkpoint", "model_type", "model_settings", "dataset", "task", "task_settings", "documents"]
+    for index, job in enumerate(jobs):
+        missing = [key for key in keys if key not in job]
+        if len(missing) > 0:
+            return jsonify({"error": f"missing fields of job {index}: {missing}"}), 400
+    events = queue.Queue()
+
+    def run_job(index, job):
+        try:
+            result = query(
+                job["model_checkpoint"],
+                job["model_type"],
+                job["model_settings"],
+                job["dataset"],
+                job["task"],
+                job["task_settings"],
+                job["documents"],
+            )
+        except Exception as e:
+            print(f"batch job {index} failed: {e}")
+            result = {"success": False, "response": {"error": {"message": str(e)}}, "status": 500}
+        events.put(("result", {"index": index, "id": job.get("id", index), "task": job.get("task"), "result": result}))
+        return result.get("success", False)
+
+    def run_batch():
+        # run jobs in separate threads, so results can be sent to the client as each job completes
+        start = time.perf_counter()
+        succeeded = 0
+        try:
+            try:
+                if len(jobs) > 1:
+                    prepare_batch(jobs)
+            except Exception as e:
+                print(f"preparing batch failed, jobs do their own work: {e}")
+            with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="batch") as executor:
+                succeeded = sum(executor.map(run_job, range(len(jobs)), jobs))
+        finally:
+            # always end the stream, so the client and the thread serving it are not left waiting
+            events.put(("done", {"jobs": len(jobs), "succeeded": succeeded, "seconds": time.perf_counter() - start}))
+
+    def generate_events():
+        while True:
+            event, data = events.get()
+            yield f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+            if event == "done":
+                break
+
+    # count tokens of the work shared by the jobs for "batch", each job counts its own for its task
+    openai_api.USAGE_TASK.set("batch")
+    openai_api.REQUEST_PRIORITY.set("interactive")
+    threading.Thread(target=openai_api.bind_request_context(run_batch), daemon=True).start()
+
+    return Response(
+        generate_events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # don't let proxies buffer events
+    )
+
+
+@app.route("/jobs", methods=["POST"])
+def post_job():
+    """Submits a query like `/query` as a job run in the background, and responds right away with the job `id`.
+
+    If an identical query was already submitted and is done or still in progress, responds with that job instead
+    (`reused` is true), unless `reuse` is false.
+    """
+    data_in = request.json  # request is sent as JSON, which is converted to a dict
+
+    keys = ["model_checkpoint", "model_type", "model_settings", "dataset", "task", "task_settings", "documents"]
+    missing = [key for key in keys if key not in data_in]
+    if len(missing) > 0:
+        return jsonify({"error": f"missing fields: {missing}"}), 400
+    job_id, reused = JOB_QUEUE.submit({key: data_in[key] for key in keys}, reuse=data_in.get("reuse", True))
+    job = JOB_QUEUE.get(job_id, include_result=False)
+    return jsonify({"id": job_id, "reused": reused, "status": job["status"]}), 202
+
+
+@app.route("/jobs", methods=["GET"])
+def get_jobs():
+    """Displays newest jobs without their results, optionally only those with a `status` (e.g., `running`)."""
+    status = request.args.get("status", None)
+    limit = request.args.get("limit", 100, type=int)
+    return jsonify({"jobs": JOB_QUEUE.list_jobs(status, limit), "counts": JOB_QUEUE.stats()})
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Displays status, text generated so far, and results of a job once it is `done`."""
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({"error": f"unknown job id: {job_id}"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def post_job_cancel(job_id):
+    """Cancels a queued job, or stops a running job before its next request to the OpenAI API or at the next piece of
+    text it generates.
+
+    A request already sent to the OpenAI API is not aborted, so its tokens may still be used. A request shared with an
+    identical request of another caller keeps running for that caller.
+    """
+    if not JOB_QUEUE.cancel(job_id):
+        return jsonify({"error": f"unknown job id: {job_id}"}), 404
+    return jsonify(JOB_QUEUE.get(job_id, include_result=False))
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def get_job_events(job_id):
+    """Streams a job as server-sent events until it is finished.
+
+    Sends a `status` event with the job (like `/jobs/<job_id>`) now and whenever its status changes, and a `delta` event
+    with `{"text": "..."}` for each piece of text it generates.
+    """
+    if JOB_QUEUE.get(job_id, include_result=False) is None:
+        return jsonify({"error": f"unknown job id: {job_id}"}), 404
+
+    def generate_events():
+        for event, data in JOB_QUEUE.subscribe(job_id):
+            yield f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+    return Response(
+        generate_events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # don't let proxies buffer events
+    )
+
+
 if __name__ == "__main__":
-    app.run(host="localhost", port=int(os.environ.get("PORT", 3008)))
+    port = int(os.environ.get("PORT", 3008))
+    if SERVER == "waitress":
+        # waitress multiplexes connections on one event loop and runs views on a pool of SERVER_THREADS threads,
+        # so many `/query` calls can wait on the OpenAI API at once in a single process
+        from waitress import serve
+
+        print(f" * serving with waitress on http://localhost:{port} ({SERVER_THREADS} threads)")
+        serve(app, host="localhost", port=port, threads=SERVER_THREADS, connection_limit=4 * SERVER_THREADS)
+    else:
+        app.run(host="localhost", port=port)
@@ -1,9 +1,23 @@
 """OpenAI API helper functions module."""
 
+import contextvars
+import functools
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
 import requests
-import tiktoken
+
+import http_client
+import openai_cache
+import rate_limiter
+import single_flight
+import token_cache
+import usage_log
 
 
 __author__ = "Adam Coscia"
@@ -12,6 +26,115 @@ __version__ = "0.1.0"
 __email__ = "acoscia125@gmail.com"
 
 
+MIN_OUTPUT_TOKENS = 500  # reserve minimum number tokens to generate
+EMBEDDING_CACHE = None  # `openai_cache.EmbeddingCache` shared by all embedding requests, set by `main.py`
+CHAT_CACHE = None  # `openai_cache.ChatCache` shared by all chat tasks, set by `main.py` (opt-in)
+TOKEN_CACHE = token_cache.TokenCache()  # tokens of documents shared by all chat tasks, reconfigured by `main.py`
+OPENAI_BASE_URL = "https://api.openai.com/v1"  # point at a local stub server for testing
+HTTP_CLIENT = http_client.HTTPClient()  # pooled connections shared by all requests, reconfigured by `main.py`
+MAX_CONCURRENCY_PER_MODEL = 8  # max in-flight requests to each model, reconfigured by `main.py`
+MODEL_CONCURRENCY = {}  # overrides `MAX_CONCURRENCY_PER_MODEL` for specific models, e.g. {"gpt-4.1": 4}
+EMBEDDING_MAX_BATCH_INPUTS = 2048  # max inputs in one request to the embedding endpoint
+EMBEDDING_MAX_BATCH_TOKENS = 300000  # max tokens summed over all inputs in one request to the embedding endpoint
+EMBEDDING_MAX_INPUT_TOKENS = 8191  # max tokens of a single input, longer inputs are truncated
+EMBEDDING_MAX_WORKERS = 8  # batches sent to the embedding endpoint at once, see also `MODEL_CONCURRENCY`
+EMBEDDING_BATCH_RETRIES = 2  # times a batch that failed with a retryable status is sent again, after `HTTP_CLIENT`
+
+CHAT_SINGLE_FLIGHT = single_flight.SingleFlight()  # coalesces identical chat requests in flight, None to disable
+EMBEDDING_SINGLE_FLIGHT = single_flight.SingleFlight()  # coalesces identical embedding requests, None to disable
+USAGE_LOG = usage_log.UsageLog(os.path.join(".", "data", "usage"))  # tokens used, reconfigured by `main.py`
+USAGE_TASK = contextvars.ContextVar("USAGE_TASK", default=None)  # task tokens are counted for, set by `main.py`
+RATE_LIMITER = rate_limiter.RateLimiter()  # RPM / TPM limits of each model, none by default, reconfigured by `main.py`
+REQUEST_PRIORITY = contextvars.ContextVar("REQUEST_PRIORITY", default="interactive")  # or "background", see `main.py`
+CANCEL_CHECK = contextvars.ContextVar("CANCEL_CHECK", default=None)  # raises once a job is cancelled, see `main.py`
+
+_model_semaphores = {}
+_model_semaphores_lock = threading.Lock()
+
+
+@contextmanager
+def model_concurrency_slot(model_checkpoint):
+    """Waits until fewer than the allowed number of requests to `model_checkpoint` are in flight, then holds a slot."""
+    with _model_semaphores_lock:
+        if model_checkpoint not in _model_semaphores:
+            limit = MODEL_CONCURRENCY.get(model_checkpoint, MAX_CONCURRENCY_PER_MODEL)
+            _model_semaphores[model_checkpoint] = threading.BoundedSemaphore(limit)
+        semaphore = _model_semaphores[model_checkpoint]
+    with semaphore:
+        yield
+
+
+def bind_request_context(fn):
+    """Returns `fn` wrapped to run with the `USAGE_TASK`, `REQUEST_PRIORITY` and `CANCEL_CHECK` of the caller, e.g. in
+    worker threads.
+    """
+    usage_task = USAGE_TASK.get()
+    priority = REQUEST_PRIORITY.get()
+    cancel_check = CANCEL_CHECK.get()
+
+    def run_in_request_context(*args, **kwargs):
+        USAGE_TASK.set(usage_task)
+        REQUEST_PRIORITY.set(priority)
+        CANCEL_CHECK.set(cancel_check)
+        return fn(*args, **kwargs)
+
+    return run_in_request_context
+
+
+def check_cancelled():
+    """Calls `CANCEL_CHECK` if it is set, which raises (e.g. `job_queue.JobCancelled`) once the job was cancelled.
+
+    Called before each request to the OpenAI API, so a cancelled job stops sending requests, e.g. map-reduce chunks.
+    """
+    cancel_check = CANCEL_CHECK.get()
+    if cancel_check is not None:
+        cancel_check()
+
+
+@contextmanager
+def rate_limited_slot(data):
+    """Waits until request `data` is within the rate limits of its model, then holds a concurrency slot of the model.
+
+    Requests are admitted in order of `REQUEST_PRIORITY` (see `RATE_LIMITER` and `MODEL_CONCURRENCY`).
+    """
+    waited = RATE_LIMITER.acquire(data["model"], rate_limiter.estimate_request_tokens(data), REQUEST_PRIORITY.get())
+    if waited > 0.001:
+        print(f"waited {waited:.2f}s for rate limit of {data['model']}")
+    with model_concurrency_slot(data["model"]):
+        check_cancelled()  # a job may have been cancelled while the request waited
+        yield
+
+
+def do_coalesced(flight, key, fn, copy_result=False):
+    """Returns result of `flight.do(key, fn, copy_result)`, raising the exceptions of `CANCEL_CHECK` only in this caller.
+
+    While `fn` runs, a cancelled caller stops the request if no other caller shares it. Otherwise the request goes on for
+    the callers sharing it, and the cancellation is raised in this caller once the request is done.
+    """
+    cancel_check = CANCEL_CHECK.get()
+    cancel_errors = []  # raised by `cancel_check` of this caller while callers share the request
+
+    def check_shared_cancelled():
+        try:
+            cancel_check()
+        except Exception as e:
+            if flight.detach(key):
+                raise  # nobody shares the request, stop it
+            cancel_errors.append(e)
+
+    def run():
+        token = CANCEL_CHECK.set(check_shared_cancelled if cancel_check is not None else None)
+        try:
+            return fn()
+        finally:
+            CANCEL_CHECK.reset(token)
+
+    result, shared = flight.do(key, run, copy_result=copy_result)
+    if len(cancel_errors) > 0:
+        raise cancel_errors[0]
+    return result, shared
+
+
 def get_num_tokens_from_message(messages, model_checkpoint):
     """Returns the number of tokens used by a list of messages.
 
@@ -22,7 +145,7 @@ def get_num_tokens_from_message(messages, model_checkpoint):
     - <https://github.com/openai/tiktoken>
     """
     try:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        encoding = get_tiktoken_encoding("cl100k_base")
     except KeyError:
         raise NotImplementedError(
             f"""get_num_tokens_from_message() is not presently implemented for model {model_checkpoint}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
@@ -32,7 +155,7 @@ def get_num_tokens_from_message(messages, model_checkpoint):
     for message in messages:
         num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += count_tokens(encoding, value)
             if key == "name":  # if there's a name, the role is omitted
                 num_tokens += -1  # role is always required and always 1 token
     num_tokens += 2  # every reply is primed with <im_start>assistant
@@ -40,6 +163,120 @@ def get_num_tokens_from_message(messages, model_checkpoint):
     return num_tokens
 
 
+def get_model_limits(model_checkpoint):
+    """Returns context window (total tokens incl. both input and output) and max output tokens of `model_checkpoint`.
+
+    See `format_chat_messages` for model settings.
+    """
+    if model_checkpoint == "gpt-4.1":
+        return 1047576, 32768
+    elif model_checkpoint == "gpt-3.5-turbo":
+        return 16385, 4096
+    return 1024, 500
+
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(encoding_name):
+    """Returns `tiktoken` tokenizer named `encoding_name`, loaded once per process."""
+    import tiktoken  # imported on first use, see `LAZY_STARTUP` in `main.py`
+
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_checkpoint):
+    """Returns `tiktoken` tokenizer of `model_checkpoint`, defaulting to `cl100k_base` for unknown models.
+
+    Tokenizers are looked up once per model and reused by every request.
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model_checkpoint)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return get_tiktoken_encoding("cl100k_base")
+
+
+def count_tokens(encoding, text):
+    """Returns number of tokens in `text`, using `TOKEN_CACHE` if it is set."""
+    if TOKEN_CACHE is None:
+        return len(encoding.encode(text))
+    return len(TOKEN_CACHE.encode_many(encoding, [text])[0])
+
+
+def clean_document(doc):
+    """Returns `doc` with newlines and repeated whitespace collapsed to single spaces, the model hates 'em."""
+    return " ".join(doc.replace("\n", " ").split())
+
+
+def encode_documents(encoding, doc_texts):
+    """Returns list of uint32 token arrays of each of `doc_texts`.
+
+    Documents in `TOKEN_CACHE` are not tokenized again, the rest are encoded in a single batch.
+    """
+    if TOKEN_CACHE is None:
+        return [np.asarray(tokens, dtype=np.uint32) for tokens in encoding.encode_batch(doc_texts)]
+    return TOKEN_CACHE.encode_many(encoding, doc_texts)
+
+
+def allocate_token_budget(doc_lengths, budget):
+    """Returns max tokens of each document so the documents of `doc_lengths` tokens fit in `budget` tokens.
+
+    Documents shorter than an even share of the budget keep all of their tokens, and the budget they leave unused is
+    split evenly between the longer documents, so no budget is wasted while any document is still truncated.
+    """
+    budget = max(budget, 0)
+    if sum(doc_lengths) <= budget:
+        return list(doc_lengths)
+    allocation = [0] * len(doc_lengths)
+    order = sorted(range(len(doc_lengths)), key=lambda i: doc_lengths[i])  # shortest documents first
+    for rank, i in enumerate(order):
+        n_remaining = len(order) - rank
+        if doc_lengths[i] * n_remaining > budget:
+            # every remaining document is longer than an even share, split the budget left between them
+            share, extra = divmod(budget, n_remaining)
+            for j, k in enumerate(order[rank:]):
+                allocation[k] = share + (1 if j < extra else 0)
+            break
+        allocation[i] = doc_lengths[i]
+        budget -= doc_lengths[i]
+    return allocation
+
+
+def pack_documents(model_checkpoint, documents, doc_sep, user_instructions, task_prompt_formatter, output_tokens):
+    """Packs `documents` in order into chunks that each fit in the context window of `model_checkpoint`.
+
+    Each chunk leaves room for the prompt of `task_prompt_formatter`, the `doc_sep` between documents, and
+    `output_tokens` generated tokens. A document too long to fit on its own is put in a chunk by itself (and is
+    truncated by `format_chat_messages`).
+
+    Returns list of chunks, each a list of documents.
+    """
+    context_window, _ = get_model_limits(model_checkpoint)
+    encoding = get_encoding(model_checkpoint)
+    doc_sep_tokens = len(encoding.encode(doc_sep))
+    message_template = task_prompt_formatter(doc_sep, "", user_instructions)
+    budget = context_window - output_tokens - get_num_tokens_from_message(message_template, model_checkpoint)
+
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    doc_lengths = [len(tokens) for tokens in encode_documents(encoding, [clean_document(doc) for doc in documents])]
+    for doc, doc_length in zip(documents, doc_lengths):
+        doc_tokens = doc_length + (doc_sep_tokens if len(chunk) > 0 else 0)
+        if len(chunk) > 0 and chunk_tokens + doc_tokens > budget:
+            chunks.append(chunk)  # chunk is full, start a new one
+            chunk = []
+            chunk_tokens = 0
+            doc_tokens -= doc_sep_tokens
+        chunk.append(doc)
+        chunk_tokens += doc_tokens
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
 def format_chat_messages(model_checkpoint, documents, doc_sep, user_instructions, task_prompt_formatter):
     """Formats `documents`, `doc_sep`, and list of `user_instructions` into OpenAI messages formatted prompt using `task_prompt_formatter` function:
 
@@ -74,25 +311,17 @@ def format_chat_messages(model_checkpoint, documents, doc_sep, user_instructions
     See: <https://platform.openai.com/docs/models/overview>
     """
     # model specific settings
-    min_output_tokens = 500  # reserve minimum number tokens to generate
-    max_output_tokens = 500  # tokens generated by models, use to limit input tokens
-    context_window = 1024  # total tokens incl. both input and output
-
-    if model_checkpoint == "gpt-4.1":
-        max_output_tokens = 32768
-        context_window = 1047576
-    elif model_checkpoint == "gpt-3.5-turbo":
-        max_output_tokens = 4096
-        context_window = 16385
+    min_output_tokens = MIN_OUTPUT_TOKENS  # reserve minimum number tokens to generate
+    context_window, max_output_tokens = get_model_limits(model_checkpoint)
 
     print(f"context window: {context_window}")
 
     # get tokenizer
-    try:
-        encoding = tiktoken.encoding_for_model(model_checkpoint)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model_checkpoint)
+
+    # encode each document once, the token counts are reused to allocate the budget and build the prompt
+    doc_texts = [clean_document(doc) for doc in documents]  # remove newlines, the model hates 'em
+    doc_tokens = encode_documents(encoding, doc_texts)
 
     # determine max tokens per doc
     doc_sep_tokens = encoding.encode(doc_sep)  # encode separator string as tokens
@@ -104,26 +333,28 @@ def format_chat_messages(model_checkpoint, documents, doc_sep, user_instructions
         - (len(doc_sep_tokens) * (len(documents) - 1))  # - tokens used by doc_sep between each doc
         - num_message_tokens  # - tokens used by messages formatting and prompt
     )
-    max_tokens_per_doc = reserved_tokens // len(documents)  # split tokens remaining evenly between documents
+    max_tokens_per_doc = allocate_token_budget([len(tokens) for tokens in doc_tokens], reserved_tokens)
 
     # create document prompt within limits of context window and output tokens
-    prompt_tokens = []
-    for i, doc in enumerate(documents):
-        doc = " ".join(doc.replace("\n", " ").split())  # remove newlines, the model hates 'em
-        tokens = encoding.encode(doc)  # encode document
-        new_tokens = tokens[0:max_tokens_per_doc]  # truncate up to max tokens per document
-        prompt_tokens.extend(new_tokens)  # add tokens to prompt_tokens
-        if i < len(documents) - 1:
-            prompt_tokens.extend(doc_sep_tokens)  # add separator token between documents
-    doc_prompt = encoding.decode(prompt_tokens)  # decode tokenized documents and separators
-
-    print(f"doc prompt tokens: {len(prompt_tokens)}")
+    # only truncated documents are decoded, the rest are used as is
+    doc_prompts = []
+    num_doc_prompt_tokens = len(doc_sep_tokens) * (len(documents) - 1)
+    for text, tokens, max_doc_tokens in zip(doc_texts, doc_tokens, max_tokens_per_doc):
+        if len(tokens) <= max_doc_tokens:
+            doc_prompts.append(text)
+        else:
+            doc_prompts.append(encoding.decode(tokens[0:max_doc_tokens].tolist()))  # truncate up to max tokens
+        num_doc_prompt_tokens += min(len(tokens), max_doc_tokens)
+    doc_prompt = doc_sep.join(doc_prompts)  # add separator between documents
+
+    print(f"doc prompt tokens: {num_doc_prompt_tokens}")
 
     # create task-specific OpenAI API formatted message by inserting document prompt
     messages = task_prompt_formatter(doc_sep, doc_prompt, user_instructions)
 
-    # check how many input tokens the prompt will use, including message formatting
-    estimated_input_tokens_used = get_num_tokens_from_message(messages, model_checkpoint)
+    # estimate how many input tokens the prompt will use, including message formatting, without encoding it again
+    # tokens can merge differently where documents and separators meet, so allow one extra token per document
+    estimated_input_tokens_used = num_message_tokens + num_doc_prompt_tokens + len(documents)
     print(f"total input tokens: {estimated_input_tokens_used}")
 
     # set max tokens to generate based on context window and input tokens
@@ -133,10 +364,95 @@ def format_chat_messages(model_checkpoint, documents, doc_sep, user_instructions
     return messages, max_tokens
 
 
-def request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed=None):
+def post_endpoint(url, headers, data):
+    """Sends `data` as JSON to OpenAI API endpoint at `url` using `HTTP_CLIENT`, which retries failed requests.
+
+    Waits until the request is within the rate limits of the model (see `RATE_LIMITER`), and for a free slot if too many
+    requests to the same model are already in flight (see `MODEL_CONCURRENCY`).
+
+    Returns the status code and JSON response. If no response was received (connection errors, timeouts, or the circuit
+    breaker is open), returns status 503 and an error shaped like the errors of the OpenAI API.
+    """
+    try:
+        with rate_limited_slot(data):
+            r = HTTP_CLIENT.post(url, headers, json.dumps(data))
+    except requests.RequestException as e:
+        return 503, {"error": {"message": str(e), "type": e.__class__.__name__}}
+    try:
+        return r.status_code, r.json()
+    except ValueError:
+        return r.status_code, {"error": {"message": r.text, "type": "invalid_response"}}
+
+
+def read_chat_stream(r, on_delta):
+    """Reads server-sent events of a streamed chat completion from response `r`, calling `on_delta` with each piece of text.
+
+    Returns the completion reassembled in the same shape as a response that was not streamed. `usage` is None if the
+    stream ended before its usage was sent, and `error` is set if the stream sent an error instead of finishing.
+    """
+    response = {"object": "chat.completion", "choices": [], "usage": None}
+    content = []
+    finish_reason = None
+    for line in r.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue  # keep-alive comments and blank lines between events
+        payload = line[len("data:") :].strip()
+        if payload == "[DONE]":
+            break
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            print(f"Warning: skipping malformed chat stream event: {payload[:100]}")
+            continue
+        if chunk.get("error") is not None:
+            response["error"] = chunk["error"]  # e.g. the server failed while generating
+            break
+        for key in ["id", "created", "model", "system_fingerprint"]:
+            if key in chunk:
+                response[key] = chunk[key]
+        if chunk.get("usage") is not None:
+            response["usage"] = chunk["usage"]  # sent in a final chunk without choices
+        for choice in chunk.get("choices", []):
+            text = choice.get("delta", {}).get("content")
+            if text:
+                content.append(text)
+                on_delta(text)
+            if choice.get("finish_reason") is not None:
+                finish_reason = choice["finish_reason"]
+    response["choices"] = [
+        {"index": 0, "message": {"role": "assistant", "content": "".join(content)}, "finish_reason": finish_reason}
+    ]
+    return response
+
+
+def post_endpoint_stream(url, headers, data, on_delta):
+    """Sends `data` as JSON to OpenAI API endpoint at `url` like `post_endpoint`, but streams the chat completion.
+
+    Calls `on_delta` with each piece of text as it arrives. Returns the status code and the reassembled response.
+    """
+    try:
+        with rate_limited_slot(data):
+            with HTTP_CLIENT.post(url, headers, json.dumps(data), stream=True) as r:
+                if r.status_code != 200:
+                    try:
+                        return r.status_code, r.json()
+                    except ValueError:
+                        return r.status_code, {"error": {"message": r.text, "type": "invalid_response"}}
+                response = read_chat_stream(r, on_delta)
+                if response.get("error") is not None:
+                    return 500, {"error": response["error"]}  # text was already sent, but the completion failed
+                return r.status_code, response
+    except requests.RequestException as e:
+        return 503, {"error": {"message": str(e), "type": e.__class__.__name__}}
+
+
+def request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed=None, on_delta=None):
     """Makes a request to OpenAI chat API endpoint.
 
-    - Saves running count of input / output / total tokens used in OpenAI calls.
+    - If `on_delta` is given, streams the response and calls `on_delta` with each piece of text as it is generated.
+      - The returned response is reassembled, so it looks the same as a response that was not streamed.
+
+    - Counts input / output / total tokens used in OpenAI calls in `USAGE_LOG`, by model and `USAGE_TASK`.
       - OpenAI charges per number of tokens used and charges differently for input vs output tokens.
 
     See: <https://cookbook.openai.com/examples/how_to_format_inputs_to_chatgpt_models>
@@ -161,9 +477,53 @@ def request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_param
     - `user`: Unique identifier for end-user monitoring and abuse detection.
 
     See: <https://platform.openai.com/docs/api-reference/chat/create>
+
+    Identical requests that are already in flight are not sent again, the response of the request in flight is shared
+    instead (see `CHAT_SINGLE_FLIGHT`). Its tokens are only counted once, and if streaming, its text is sent to
+    `on_delta` as a single piece once it is done.
+
+    If `on_delta` raises (e.g. `job_queue.JobCancelled`), the exception is only raised in this caller, like cancellations
+    (see `do_coalesced`). The request is
+    stopped if no other caller shares it, otherwise it goes on for them without sending more text to `on_delta`.
     """
+    check_cancelled()
+    if CHAT_SINGLE_FLIGHT is None:
+        return _request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed, on_delta)
+
+    key = openai_cache.hash_chat_request(model_checkpoint, messages, max_tokens, endpoint_params, seed)
+    delta_errors = []  # raised by `on_delta` of this caller while callers share the request
+
+    def forward_delta(text):
+        if len(delta_errors) > 0:
+            return  # this caller stopped listening, keep streaming for the callers sharing the request
+        try:
+            on_delta(text)
+        except Exception as e:
+            if CHAT_SINGLE_FLIGHT.detach(key):
+                raise  # nobody shares the request, stop it
+            delta_errors.append(e)
+
+    stream_callback = forward_delta if on_delta is not None else None
+    result, shared = do_coalesced(
+        CHAT_SINGLE_FLIGHT,
+        key,
+        lambda: _request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed, stream_callback),
+        copy_result=True,  # callers may modify the response
+    )
+    if len(delta_errors) > 0:
+        raise delta_errors[0]
+    if shared:
+        print("coalesced chat request with identical request in flight")
+        status, response, _, _ = result
+        if on_delta is not None and status == 200:
+            on_delta(response["choices"][0]["message"]["content"])
+    return result
+
+
+def _request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed=None, on_delta=None):
+    """Makes a request to OpenAI chat API endpoint, see `request_chat_endpoint`."""
     # set up request parameters
-    url = "https://api.openai.com/v1/chat/completions"
+    url = f"{OPENAI_BASE_URL}/chat/completions"
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {endpoint_params['API_TOKEN']}"}
     data = {
         "model": model_checkpoint,
@@ -178,40 +538,34 @@ def request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_param
     }
 
     # make a POST request to get summary
-    r = requests.post(url, headers=headers, data=json.dumps(data))
-    status = r.status_code
+    if on_delta is not None:
+        data["stream"] = True
+        data["stream_options"] = {"include_usage": True}  # token usage is sent in the last event of the stream
+        status, response = post_endpoint_stream(url, headers, data, on_delta)
+    else:
+        status, response = post_endpoint(url, headers, data)
     print(f"API response code: {status}")
 
-    # response ok, proceed as normal
-    response = r.json()
-
-    # save copy of response
-    fp = os.path.join(".", "data", "usage", "response.json")
-    with open(fp, "w") as f:
-        f.write(json.dumps(response))
+    # keep copy of response, written to `data/usage/response.json` in the background
+    USAGE_LOG.record_response(response)
 
     if status == 200:
-        # keep track of how many tokens have been used so far, for each model checkpoint
-        model_used = response["model"]
-
-        try:
-            fp = os.path.join(".", "data", "usage", f"tokens_used_{model_used}.json")
-            with open(fp, "r") as f:
-                tokens_used = json.load(f)
-        except IOError:
-            tokens_used = {"input": 0, "output": 0, "total": 0}
-
+        if response.get("usage") is None:
+            # streams of proxies and compatible servers may end without usage, count the tokens ourselves
+            response.setdefault("model", model_checkpoint)
+            output_tokens = count_tokens(get_encoding(model_checkpoint), response["choices"][0]["message"]["content"])
+            input_tokens = get_num_tokens_from_message(messages, model_checkpoint)
+            response["usage"] = {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            }
+
+        # keep track of how many tokens have been used so far, for each model checkpoint and task
         input_tokens_used = response["usage"]["prompt_tokens"]
         output_tokens_used = response["usage"]["completion_tokens"]
         total_tokens_used = response["usage"]["total_tokens"]
-
-        tokens_used["input"] += input_tokens_used
-        tokens_used["output"] += output_tokens_used
-        tokens_used["total"] += total_tokens_used
-
-        fp = os.path.join(".", "data", "usage", f"tokens_used_{model_used}.json")
-        with open(fp, "w") as f:
-            json.dump(tokens_used, f, indent=2)
+        USAGE_LOG.record(response["model"], USAGE_TASK.get(), input_tokens_used, output_tokens_used, total_tokens_used)
 
         print(f"total tokens used: {total_tokens_used}")
 
@@ -222,9 +576,156 @@ def request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_param
 
 
 def request_embedding_endpoint(model_checkpoint, user_query, endpoint_params):
+    """Makes a request to OpenAI embedding API endpoint for the inputs in `user_query` that are not in `EMBEDDING_CACHE`.
+
+    Embeddings of cache hits and new embeddings are reassembled into a single response in input order, shaped like the
+    response of the endpoint. Tokens used only count the inputs that were sent to the endpoint.
+
+    The cache is skipped when `EMBEDDING_CACHE` is None or embeddings are requested in `base64` format.
+
+    Inputs that are already being embedded by an identical request in flight are not sent again, the response of the
+    request in flight is shared instead (see `EMBEDDING_SINGLE_FLIGHT`).
+    """
+    check_cancelled()
+    if EMBEDDING_CACHE is None or endpoint_params["format"] != "float":
+        texts = [user_query] if isinstance(user_query, str) else list(user_query)
+        return request_coalesced_embedding_batches(model_checkpoint, texts, endpoint_params)
+
+    dimensions = endpoint_params["dimensions"]
+    texts = [user_query] if isinstance(user_query, str) else list(user_query)
+    embeddings = EMBEDDING_CACHE.get_many(model_checkpoint, dimensions, texts)
+    input_tokens_used = 0
+
+    # only request embeddings for unique inputs that were not in the cache
+    missing_texts = list(dict.fromkeys(text for i, text in enumerate(texts) if i not in embeddings))
+    print(f"embedding cache hits: {len(embeddings)}, misses: {len(texts) - len(embeddings)}")
+    if len(missing_texts) > 0:
+        status, response, input_tokens_used = request_coalesced_embedding_batches(
+            model_checkpoint, missing_texts, endpoint_params
+        )
+        if status != 200:
+            return status, response, None
+        new_embeddings = [e["embedding"] for e in sorted(response["data"], key=lambda x: x["index"])]
+        EMBEDDING_CACHE.put_many(model_checkpoint, dimensions, missing_texts, new_embeddings)
+        new_embeddings = dict(zip(missing_texts, new_embeddings))
+        embeddings.update({i: new_embeddings[text] for i, text in enumerate(texts) if i not in embeddings})
+
+    response = {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": embeddings[i]} for i in range(len(texts))],
+        "model": model_checkpoint,
+        "usage": {"prompt_tokens": input_tokens_used, "total_tokens": input_tokens_used},
+    }
+    return 200, response, input_tokens_used
+
+
+def request_coalesced_embedding_batches(model_checkpoint, texts, endpoint_params):
+    """Makes requests like `request_embedding_batches`, or shares the response of an identical request in flight.
+
+    The shared response is not copied, since embeddings can be large, so callers must not modify it.
+
+    If this caller is cancelled while batches are sent, the remaining batches are only sent for the callers sharing the
+    request (see `do_coalesced`).
+    """
+    if EMBEDDING_SINGLE_FLIGHT is None:
+        return request_embedding_batches(model_checkpoint, texts, endpoint_params)
+
+    key = openai_cache.hash_embedding_request(model_checkpoint, texts, endpoint_params)
+    result, shared = do_coalesced(
+        EMBEDDING_SINGLE_FLIGHT, key, lambda: request_embedding_batches(model_checkpoint, texts, endpoint_params)
+    )
+    if shared:
+        print(f"coalesced embedding request of {len(texts)} inputs with identical request in flight")
+    return result
+
+
+def batch_embedding_inputs(encoding, texts):
+    """Returns `texts` truncated to `EMBEDDING_MAX_INPUT_TOKENS`, and list of batches of indexes of `texts`.
+
+    Consecutive inputs are grouped into batches of at most `EMBEDDING_MAX_BATCH_INPUTS` inputs and
+    `EMBEDDING_MAX_BATCH_TOKENS` tokens, the limits of a single request to the embedding endpoint.
+    """
+    texts = list(texts)
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, tokens in enumerate(encoding.encode_batch(texts)):
+        if len(tokens) > EMBEDDING_MAX_INPUT_TOKENS:
+            print(f"Warning: embedding input {i} has {len(tokens)} tokens, truncating to {EMBEDDING_MAX_INPUT_TOKENS}")
+            tokens = tokens[:EMBEDDING_MAX_INPUT_TOKENS]
+            texts[i] = encoding.decode(tokens)
+        if len(batch) == EMBEDDING_MAX_BATCH_INPUTS or batch_tokens + len(tokens) > EMBEDDING_MAX_BATCH_TOKENS:
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += len(tokens)
+    if len(batch) > 0:
+        batches.append(batch)
+    return texts, batches
+
+
+def request_embedding_batches(model_checkpoint, texts, endpoint_params):
+    """Makes requests to OpenAI embedding API endpoint for `texts` split into batches the endpoint accepts.
+
+    Batches are sent in parallel, requests over the concurrency limit of the model wait for a free slot. Batches that
+    fail with a status worth retrying (`http_client.RETRY_STATUS_CODES`, including 503 when no response was received)
+    are sent again with backoff up to `EMBEDDING_BATCH_RETRIES` times, without resending the batches that succeeded.
+    Other errors, e.g. invalid inputs, are returned right away.
+
+    Returns status, response with the embeddings of all batches in input order, and input tokens summed over all
+    batches. If a batch still fails, returns its status and response instead.
+    """
+    texts, batches = batch_embedding_inputs(get_encoding(model_checkpoint), texts)
+    if len(batches) == 1:
+        return _request_embedding_endpoint(model_checkpoint, texts, endpoint_params)
+    print(f"embedding {len(texts)} inputs in {len(batches)} batches")
+
+    @bind_request_context  # count tokens and rate limit batches sent from worker threads like the caller
+    def request_batch(batch):
+        return _request_embedding_endpoint(model_checkpoint, [texts[i] for i in batch], endpoint_params)
+
+    data = [None] * len(texts)
+    input_tokens_used = 0
+    pending = batches
+    with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+        for attempt in range(EMBEDDING_BATCH_RETRIES + 1):
+            failed = []
+            for batch, (status, response, batch_tokens_used) in zip(pending, executor.map(request_batch, pending)):
+                if status != 200:
+                    failed.append((batch, status, response))
+                    continue
+                input_tokens_used += batch_tokens_used
+                for e in response["data"]:
+                    data[batch[e["index"]]] = {**e, "index": batch[e["index"]]}  # index in batch -> index in texts
+            if len(failed) == 0:
+                break
+            if attempt == EMBEDDING_BATCH_RETRIES or any(
+                status not in http_client.RETRY_STATUS_CODES for _, status, _ in failed
+            ):
+                break  # retrying would not help, e.g. 400 invalid input or 401 invalid API key
+            backoff = HTTP_CLIENT.get_backoff(attempt)
+            print(f"{len(failed)} of {len(pending)} embedding batches failed, retrying in {backoff:.1f} s...")
+            time.sleep(backoff)
+            pending = [batch for batch, _, _ in failed]
+    if len(failed) > 0:
+        # return a non-retryable error first, it is the one to fix
+        _, status, response = min(failed, key=lambda x: x[1] in http_client.RETRY_STATUS_CODES)
+        return status, response, None
+
+    response = {
+        "object": "list",
+        "data": data,
+        "model": model_checkpoint,
+        "usage": {"prompt_tokens": input_tokens_used, "total_tokens": input_tokens_used},
+    }
+    return 200, response, input_tokens_used
+
+
+def _request_embedding_endpoint(model_checkpoint, user_query, endpoint_params):
     """Makes a request to OpenAI embedding API endpoint.
 
-    - Saves running count of input / output / total tokens used in OpenAI calls.
+    - Counts input / output / total tokens used in OpenAI calls in `USAGE_LOG`, by model and `USAGE_TASK`.
       - OpenAI charges per number of tokens used and charges differently for input vs output tokens.
 
     See: <https://platform.openai.com/docs/guides/embeddings>
@@ -242,7 +743,7 @@ def request_embedding_endpoint(model_checkpoint, user_query, endpoint_params):
     See: <https://platform.openai.com/docs/api-reference/embeddings/create>
     """
     # set up request parameters
-    url = "https://api.openai.com/v1/embeddings"
+    url = f"{OPENAI_BASE_URL}/embeddings"
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {endpoint_params['API_TOKEN']}"}
     data = {
         "input": user_query,
@@ -253,38 +754,17 @@ def request_embedding_endpoint(model_checkpoint, user_query, endpoint_params):
         data["dimensions"] = endpoint_params["dimensions"]  # not using default setting
 
     # make a POST request to get summary
-    r = requests.post(url, headers=headers, data=json.dumps(data))
-    status = r.status_code
+    status, response = post_endpoint(url, headers, data)
     print(f"API response code: {status}")
 
-    # response ok, proceed as normal
-    response = r.json()
-
-    # save copy of response
-    fp = os.path.join(".", "data", "usage", "response.json")
-    with open(fp, "w") as f:
-        f.write(json.dumps(response))
+    # keep copy of response, written to `data/usage/response.json` in the background
+    USAGE_LOG.record_response(response)
 
     if status == 200:
-        # keep track of how many tokens have been used so far, for each model checkpoint
-        model_used = response["model"]
-
-        try:
-            fp = os.path.join(".", "data", "usage", f"tokens_used_{model_used}.json")
-            with open(fp, "r") as f:
-                tokens_used = json.load(f)
-        except IOError:
-            tokens_used = {"input": 0, "output": 0, "total": 0}
-
+        # keep track of how many tokens have been used so far, for each model checkpoint and task
         input_tokens_used = response["usage"]["prompt_tokens"]
         total_tokens_used = response["usage"]["total_tokens"]
-
-        tokens_used["input"] += input_tokens_used
-        tokens_used["total"] += total_tokens_used
-
-        fp = os.path.join(".", "data", "usage", f"tokens_used_{model_used}.json")
-        with open(fp, "w") as f:
-            json.dump(tokens_used, f, indent=2)
+        USAGE_LOG.record(response["model"], USAGE_TASK.get(), input_tokens_used, 0, total_tokens_used)
 
         print(f"total tokens used: {total_tokens_used}")
 
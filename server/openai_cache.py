@@ -0,0 +1,183 @@
+"""OpenAI response cache helper module.
+
+`EmbeddingCache` persists embeddings in SQLite, keyed by a hash of the model, number of dimensions and input text, so
+only inputs that have never been embedded before are sent to the embedding endpoint.
+
+`ChatCache` keeps recent chat responses in memory, keyed by a hash of the formatted messages, model and sampling
+parameters, so repeating a pile operation with the same settings does not call the chat endpoint again.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+SQLITE_MAX_VARIABLES = 900  # stay below SQLite's limit on `?` parameters in a single statement
+
+
+def hash_embedding_input(model_checkpoint, dimensions, text):
+    """Returns content address of `text` embedded by `model_checkpoint` with `dimensions`."""
+    return hashlib.sha256(f"{model_checkpoint}\0{dimensions}\0{text}".encode("utf-8")).hexdigest()
+
+
+def hash_chat_request(model_checkpoint, messages, max_tokens, endpoint_params, seed):
+    """Returns content address of a chat request, ignoring the API token in `endpoint_params`."""
+    request = {
+        "model": model_checkpoint,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "params": {key: value for key, value in endpoint_params.items() if key != "API_TOKEN"},
+        "seed": seed,
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def hash_embedding_request(model_checkpoint, texts, endpoint_params):
+    """Returns content address of an embedding request for `texts`, ignoring the API token in `endpoint_params`."""
+    request = {
+        "model": model_checkpoint,
+        "input": list(texts),
+        "params": {key: value for key, value in endpoint_params.items() if key != "API_TOKEN"},
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent, size-bounded cache of embeddings stored as float32 blobs in SQLite.
+
+    Least recently used embeddings are evicted once the cache holds more than `max_entries`. Counts of cache hits and
+    misses since the server started are kept in `hits` and `misses`.
+    """
+
+    def __init__(self, path, max_entries=50000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # one connection is shared between Flask request threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, model_checkpoint, dimensions, texts):
+        """Returns dict of `{index: embedding}` for each of `texts` found in the cache."""
+        keys = [hash_embedding_input(model_checkpoint, dimensions, text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = list(set(keys[start : start + SQLITE_MAX_VARIABLES]))
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+                self._conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})", [time.time(), *chunk]
+                )
+            self._conn.commit()
+            embeddings = {
+                i: np.frombuffer(found[key], dtype=np.float32).tolist() for i, key in enumerate(keys) if key in found
+            }
+            self.hits += len(embeddings)
+            self.misses += len(keys) - len(embeddings)
+        return embeddings
+
+    def put_many(self, model_checkpoint, dimensions, texts, embeddings):
+        """Adds `embeddings` of `texts` to the cache, then evicts least recently used entries over `max_entries`."""
+        now = time.time()
+        rows = [
+            (
+                hash_embedding_input(model_checkpoint, dimensions, text),
+                np.asarray(embedding, dtype=np.float32).tobytes(),
+                now,
+            )
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            (n_entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (n_entries - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def stats(self):
+        """Returns dict of cache size and hit / miss counts."""
+        with self._lock:
+            (n_entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return {"entries": n_entries, "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+class ChatCache:
+    """In-memory cache of chat responses that expire after `ttl` seconds.
+
+    Least recently used responses are evicted once the cache holds more than `max_entries`. Counts of cache hits and
+    misses since the server started are kept in `hits` and `misses`.
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expiry time, value), ordered from least to most recently used
+
+    def get(self, key):
+        """Returns copy of value cached for `key`, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]  # expired
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])  # callers may modify the response
+
+    def put(self, key, value):
+        """Caches copy of `value` for `key`, then evicts least recently used entries over `max_entries`."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Returns dict of cache size and hit / miss counts."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
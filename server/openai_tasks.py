@@ -1,13 +1,17 @@
 """OpenAI tasks helper module."""
 
-import evaluate
-import pandas as pd
-import spacy
-from scipy import spatial  # for calculating vector similarities for embedding search
-from sklearn.metrics.pairwise import cosine_similarity  # for calculating vector similarities for sentence comparison
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+
+import embedding_search
 import openai_api
+import openai_cache
 import openai_prompts
+import sentence_segmenter
+import summary_eval
 
 
 __author__ = "Adam Coscia"
@@ -17,7 +21,160 @@ __email__ = "acoscia125@gmail.com"
 
 
 DOC_SEP = "|||||"  # a special separator string to put between documents, same as used in `multi-news` dataset
-NLP = spacy.load("data/models/en_core_web_sm-3.8.0")
+# splits texts for sentence comparison, reconfigured by `main.py`
+SENTENCE_SEGMENTER = sentence_segmenter.SentenceSegmenter("data/models/en_core_web_sm-3.8.0")
+MAP_REDUCE_MAX_LEVELS = 4  # reduce levels before truncating whatever is left into a single request
+MAP_REDUCE_MAX_WORKERS = 8  # chunks sent to the chat endpoint at once during map-reduce
+COMPARE_BLOCK_SIZE = 1024  # query sentences whose links are computed at once
+COMPARE_MAX_MEMORY = 256 * 2**20  # bytes of similarity scores held at once, reconfigured by `main.py`
+COMPARE_MAX_WORKERS = os.cpu_count() or 1  # threads scoring document sentences, reconfigured by `main.py`
+SUMMARY_EVALUATOR = summary_eval.SummaryEvaluator()  # scores summaries with ROUGE, reconfigured by `main.py`
+SUMMARY_EVALUATION = "sync"  # "sync" scores summaries before responding, "async" in the background, "off" never
+STREAM_CALLBACK = contextvars.ContextVar("STREAM_CALLBACK", default=None)  # set by streaming requests, see `main.py`
+LINKS_CALLBACK = contextvars.ContextVar("LINKS_CALLBACK", default=None)  # set by streaming requests, see `main.py`
+
+
+# single document and multiple document prompt formatters for each summary length, used by map-reduce
+SUMMARIZE_PROMPT_FORMATTERS = {
+    "concise": (openai_prompts.openai_summarize_concise_singledoc, openai_prompts.openai_summarize_concise_multidoc),
+    "verbose": (openai_prompts.openai_summarize_verbose_singledoc, openai_prompts.openai_summarize_verbose_multidoc),
+}
+
+
+def request_cached_chat_endpoint(
+    model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed=None
+):
+    """Makes a request to OpenAI chat API endpoint, or reuses the response to an identical request from `CHAT_CACHE`.
+
+    Set `bypass_cache` in `task_settings` to always call the endpoint (the new response still replaces the cached one).
+
+    Saves whether the response came from the cache in `results["cached"]`.
+
+    If a callback is set in `STREAM_CALLBACK`, the response is streamed and the callback is called with each piece of
+    text as it is generated (a cached response is sent as a single piece).
+    """
+    cache = openai_api.CHAT_CACHE
+    on_delta = STREAM_CALLBACK.get()
+    results["cached"] = False
+    if cache is None:
+        return openai_api.request_chat_endpoint(model_checkpoint, messages, max_tokens, endpoint_params, seed, on_delta)
+
+    key = openai_cache.hash_chat_request(model_checkpoint, messages, max_tokens, endpoint_params, seed)
+    if not task_settings.get("bypass_cache", False):
+        cached = cache.get(key)
+        if cached is not None:
+            print("chat cache hit")
+            results["cached"] = True
+            if on_delta is not None:
+                on_delta(cached[1]["choices"][0]["message"]["content"])
+            return cached
+
+    status, response, input_tokens_used, output_tokens_used = openai_api.request_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, seed, on_delta
+    )
+    if status == 200:
+        cache.put(key, (status, response, input_tokens_used, output_tokens_used))
+    return status, response, input_tokens_used, output_tokens_used
+
+
+def request_map_reduce_chat_endpoint(
+    model_checkpoint,
+    endpoint_params,
+    task_settings,
+    documents,
+    results,
+    user_instructions,
+    prompt_formatters,
+    seed=None,
+):
+    """Makes requests to OpenAI chat API endpoint over piles of `documents` too large for a single context window.
+
+    `prompt_formatters` is a pair of single document and multiple document prompt formatter functions of the task.
+
+    - Map: documents are packed into chunks that fit in the context window, and each chunk is processed in parallel.
+    - Reduce: the partial results are treated as documents and processed again, recursively if they still do not fit,
+      until a single request can combine them.
+
+    If the pile fits in the context window, this makes the same single request as the task would without map-reduce.
+
+    Returns status, response, input tokens summed over all requests, and output tokens of the final request.
+    Saves number of reduce levels and requests in `results["map_reduce"]`.
+    """
+    singledoc_prompt_formatter, multidoc_prompt_formatter = prompt_formatters
+    context_window, max_output_tokens = openai_api.get_model_limits(model_checkpoint)
+    map_output_tokens = min(max_output_tokens, context_window // 4)  # leave room in the context window for outputs
+
+    @openai_api.bind_request_context  # count tokens and rate limit chunks sent from worker threads like the caller
+    def request_chat(chunk):
+        prompt_formatter = singledoc_prompt_formatter if len(chunk) == 1 else multidoc_prompt_formatter
+        messages, max_tokens = openai_api.format_chat_messages(
+            model_checkpoint, chunk, DOC_SEP, user_instructions, prompt_formatter
+        )
+        return request_cached_chat_endpoint(
+            model_checkpoint, messages, max_tokens, endpoint_params, task_settings, {}, seed
+        )
+
+    level = 0
+    n_requests = 0
+    total_input_tokens_used = 0
+    while True:
+        chunks = openai_api.pack_documents(
+            model_checkpoint, documents, DOC_SEP, user_instructions, multidoc_prompt_formatter, map_output_tokens
+        )
+        if len(chunks) == 1 or level == MAP_REDUCE_MAX_LEVELS:
+            break  # remaining documents fit in one request (or are truncated to fit)
+        print(f"map-reduce level {level}: {len(documents)} documents in {len(chunks)} chunks")
+
+        # map chunks in parallel, requests over the concurrency limit of the model wait for a free slot
+        with ThreadPoolExecutor(max_workers=MAP_REDUCE_MAX_WORKERS) as executor:
+            responses = list(executor.map(request_chat, chunks))
+        n_requests += len(responses)
+
+        for status, response, input_tokens_used, _ in responses:
+            if status != 200:
+                results["map_reduce"] = {"levels": level, "requests": n_requests}
+                return status, response, None, None
+            total_input_tokens_used += input_tokens_used
+
+        # reduce partial results in the next level
+        documents = [response["choices"][0]["message"]["content"] for _, response, _, _ in responses]
+        level += 1
+
+    prompt_formatter = singledoc_prompt_formatter if len(documents) == 1 else multidoc_prompt_formatter
+    messages, max_tokens = openai_api.format_chat_messages(
+        model_checkpoint, documents, DOC_SEP, user_instructions, prompt_formatter
+    )
+    status, response, input_tokens_used, output_tokens_used = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
+    )
+    results["map_reduce"] = {"levels": level, "requests": n_requests + 1}
+    if status != 200:
+        return status, response, None, None
+    return status, response, total_input_tokens_used + input_tokens_used, output_tokens_used
+
+
+def prepare_batch(chat_documents, embedding_groups, embedding_model_checkpoint):
+    """Does the work shared by the jobs of a batch once, before the jobs run in parallel and find it in the caches.
+
+    - `chat_documents`: dict of model checkpoint to documents of chat jobs, tokenized in one batch into `TOKEN_CACHE`
+    - `embedding_groups`: list of `(endpoint_params, texts, inputs)` of embedding jobs with the same endpoint params,
+      where `texts` are segmented into sentences in one batch, and their sentences and `inputs` (e.g., search queries)
+      are embedded into `EMBEDDING_CACHE` in one request
+    """
+    if openai_api.TOKEN_CACHE is not None:
+        for model_checkpoint, documents in chat_documents.items():
+            doc_texts = list(dict.fromkeys(openai_api.clean_document(doc) for doc in documents))
+            openai_api.encode_documents(openai_api.get_encoding(model_checkpoint), doc_texts)
+
+    for endpoint_params, texts, inputs in embedding_groups:
+        texts = list(dict.fromkeys(texts))
+        all_sents_spans = SENTENCE_SEGMENTER.split_many(texts) if len(texts) > 0 else []
+        if openai_api.EMBEDDING_CACHE is None or endpoint_params["format"] != "float":
+            continue  # embeddings would not be reused by the jobs
+        sentences = [text[start:end] for text, spans in zip(texts, all_sents_spans) for start, end in spans]
+        embedding_inputs = list(dict.fromkeys([*inputs, *sentences]))
+        if len(embedding_inputs) > 0:
+            openai_api.request_embedding_endpoint(embedding_model_checkpoint, embedding_inputs, endpoint_params)
 
 
 def run_openai_chat_analyze(model_checkpoint, endpoint_params, task_settings, documents, results, seed=None):
@@ -35,19 +192,32 @@ def run_openai_chat_analyze(model_checkpoint, endpoint_params, task_settings, do
     print("prompt:")
     print(prompt_formatter(DOC_SEP, "", user_instructions))
 
-    # formats documents into custom prompt and returns chat messages for OpenAI API
-    messages, max_tokens = openai_api.format_chat_messages(
-        model_checkpoint,
-        documents,
-        DOC_SEP,
-        user_instructions,
-        prompt_formatter,
-    )
+    if task_settings.get("map_reduce", False):
+        # process piles too large for the context window in chunks, then combine the partial results
+        status, response, _, _ = request_map_reduce_chat_endpoint(
+            model_checkpoint,
+            endpoint_params,
+            task_settings,
+            documents,
+            results,
+            user_instructions,
+            (openai_prompts.openai_analyze_singledoc, openai_prompts.openai_analyze_multidoc),
+            seed,
+        )
+    else:
+        # formats documents into custom prompt and returns chat messages for OpenAI API
+        messages, max_tokens = openai_api.format_chat_messages(
+            model_checkpoint,
+            documents,
+            DOC_SEP,
+            user_instructions,
+            prompt_formatter,
+        )
 
-    # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
-    )
+        # make a request to OpenAI using formatted messages and recieve response
+        status, response, _, _ = request_cached_chat_endpoint(
+            model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
+        )
 
     if status == 200:
         text = response["choices"][0]["message"]["content"]  # get text from response
@@ -62,7 +232,9 @@ def run_openai_chat_analyze(model_checkpoint, endpoint_params, task_settings, do
 def run_openai_chat_summarize(model_checkpoint, endpoint_params, task_settings, documents, results, seed=None):
     """Make OpenAI API request to summarize documents.
 
-    Evaluates summary using ROUGE.
+    Evaluates summary using ROUGE. Set `evaluation` in `task_settings` to "async" to score the summary in the background
+    instead (the scores are fetched later using `results["stats"]["evaluation_id"]`), or to "off" to skip it. Defaults
+    to `SUMMARY_EVALUATION`.
 
     See: <https://huggingface.co/docs/transformers/tasks/summarization#evaluate>
     """
@@ -83,28 +255,45 @@ def run_openai_chat_summarize(model_checkpoint, endpoint_params, task_settings,
     print("prompt:")
     print(prompt_formatter(DOC_SEP, "", user_instructions))
 
-    # formats documents into summarization prompt and returns chat messages for OpenAI API
-    messages, max_tokens = openai_api.format_chat_messages(
-        model_checkpoint,
-        documents,
-        DOC_SEP,
-        user_instructions,
-        prompt_formatter,
-    )
+    if task_settings.get("map_reduce", False):
+        # process piles too large for the context window in chunks, then combine the partial results
+        status, response, input_tokens_used, output_tokens_used = request_map_reduce_chat_endpoint(
+            model_checkpoint,
+            endpoint_params,
+            task_settings,
+            documents,
+            results,
+            user_instructions,
+            SUMMARIZE_PROMPT_FORMATTERS[task_settings["summary_length"]],
+            seed,
+        )
+    else:
+        # formats documents into summarization prompt and returns chat messages for OpenAI API
+        messages, max_tokens = openai_api.format_chat_messages(
+            model_checkpoint,
+            documents,
+            DOC_SEP,
+            user_instructions,
+            prompt_formatter,
+        )
 
-    # make a request to OpenAI using formatted messages and recieve response
-    status, response, input_tokens_used, output_tokens_used = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
-    )
+        # make a request to OpenAI using formatted messages and recieve response
+        status, response, input_tokens_used, output_tokens_used = request_cached_chat_endpoint(
+            model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
+        )
 
     if status == 200:
         # get summary text from response
         summary_text = response["choices"][0]["message"]["content"]
 
-        # evaluate summary with ROGUE
-        rouge = evaluate.load("rouge")
-        text = "".join([" ".join(doc.replace("\n", " ").split()) for doc in documents])
-        rogue_result = rouge.compute(predictions=[summary_text], references=[text], use_stemmer=True)
+        # evaluate summary with ROGUE, scores are None until a background evaluation is done
+        evaluation = task_settings.get("evaluation", SUMMARY_EVALUATION)
+        rogue_result = {"rouge1": None, "rouge2": None, "rougeL": None}
+        evaluation_id = None
+        if evaluation == "sync":
+            rogue_result = SUMMARY_EVALUATOR.score(summary_text, documents)
+        elif evaluation == "async":
+            evaluation_id = SUMMARY_EVALUATOR.submit(summary_text, documents)
 
         # save results
         results["success"] = True
@@ -113,6 +302,7 @@ def run_openai_chat_summarize(model_checkpoint, endpoint_params, task_settings,
             "rouge1": rogue_result["rouge1"],
             "rouge2": rogue_result["rouge2"],
             "rougeL": rogue_result["rougeL"],
+            "evaluation_id": evaluation_id,
             "percent_reduction": {
                 "input": input_tokens_used,
                 "output": output_tokens_used,
@@ -141,19 +331,32 @@ def run_openai_chat_extract(model_checkpoint, endpoint_params, task_settings, do
     print("prompt:")
     print(prompt_formatter(DOC_SEP, "", user_instructions))
 
-    # formats documents into custom prompt and returns chat messages for OpenAI API
-    messages, max_tokens = openai_api.format_chat_messages(
-        model_checkpoint,
-        documents,
-        DOC_SEP,
-        user_instructions,
-        prompt_formatter,
-    )
+    if task_settings.get("map_reduce", False):
+        # process piles too large for the context window in chunks, then combine the partial results
+        status, response, _, _ = request_map_reduce_chat_endpoint(
+            model_checkpoint,
+            endpoint_params,
+            task_settings,
+            documents,
+            results,
+            user_instructions,
+            (openai_prompts.openai_extract_singledoc, openai_prompts.openai_extract_multidoc),
+            seed,
+        )
+    else:
+        # formats documents into custom prompt and returns chat messages for OpenAI API
+        messages, max_tokens = openai_api.format_chat_messages(
+            model_checkpoint,
+            documents,
+            DOC_SEP,
+            user_instructions,
+            prompt_formatter,
+        )
 
-    # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
-    )
+        # make a request to OpenAI using formatted messages and recieve response
+        status, response, _, _ = request_cached_chat_endpoint(
+            model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
+        )
 
     if status == 200:
         text = response["choices"][0]["message"]["content"]  # get text from response
@@ -190,8 +393,8 @@ def run_openai_chat_classify(model_checkpoint, endpoint_params, task_settings, d
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -229,8 +432,8 @@ def run_openai_chat_questions(model_checkpoint, endpoint_params, task_settings,
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -268,8 +471,8 @@ def run_openai_chat_tasks(model_checkpoint, endpoint_params, task_settings, docu
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -309,8 +512,8 @@ def run_openai_chat_explain(model_checkpoint, endpoint_params, task_settings, do
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -350,8 +553,8 @@ def run_openai_chat_answer(model_checkpoint, endpoint_params, task_settings, doc
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -389,8 +592,8 @@ def run_openai_chat_custom(model_checkpoint, endpoint_params, task_settings, doc
     )
 
     # make a request to OpenAI using formatted messages and recieve response
-    status, response, _, _ = openai_api.request_chat_endpoint(
-        model_checkpoint, messages, max_tokens, endpoint_params, seed
+    status, response, _, _ = request_cached_chat_endpoint(
+        model_checkpoint, messages, max_tokens, endpoint_params, task_settings, results, seed
     )
 
     if status == 200:
@@ -406,7 +609,11 @@ def run_openai_chat_custom(model_checkpoint, endpoint_params, task_settings, doc
 def run_openai_embedding_search(model_checkpoint, endpoint_params, task_settings, embeddings, results):
     """Make OpenAI API request to get embedding of user query and search for related strings (e.g., nodes in a knowledge graph or documents).
 
-    Returns a list of strings and relatedness scores, sorted from most related to least.
+    `embeddings` is a search index (e.g., `embedding_search.ExactSearchIndex` or `ann_index.IVFSearchIndex`) over pre-computed embeddings of the strings.
+
+    The query can be a single string or a list of strings, which are embedded and searched in one batch.
+
+    Returns a list of strings and relatedness scores, sorted from most related to least (one list per query if a list of queries is given).
 
     See: <https://cookbook.openai.com/examples/question_answering_using_embeddings>
     """
@@ -416,34 +623,69 @@ def run_openai_embedding_search(model_checkpoint, endpoint_params, task_settings
     )
 
     if status == 200:
-        # set comparator function and number of documents to retrieve
-        compute_relatedness = lambda x, y: 1 - spatial.distance.cosine(x, y)
+        # set number of documents to retrieve
         top_n = task_settings["top_n"] if "top_n" in task_settings else len(embeddings)
 
-        # get query embedding
-        query_embedding = response["data"][0]["embedding"]
-
-        # score each row of the source texts (documents, nodes) using their pre-computed embeddings
-        all_texts_scored = [
-            (row[task_settings["id_col"]], compute_relatedness(query_embedding, row["embedding"]))
-            for _, row in embeddings.iterrows()
+        # get query embeddings
+        query_embeddings = [e["embedding"] for e in sorted(response["data"], key=lambda x: x["index"])]
+
+        # score every row of the source texts (documents, nodes) and take the top_n for each query
+        top_indices, top_scores = embeddings.search(query_embeddings, top_n)
+        text_ids = embeddings.metadata[task_settings["id_col"]].to_numpy()
+        top_texts = [
+            [
+                {"id": text_id, "score": score}
+                for text_id, score in zip(text_ids[indices[indices >= 0]].tolist(), scores[indices >= 0].tolist())
+            ]
+            for indices, scores in zip(top_indices, top_scores)  # approximate indexes pad missing results with -1
         ]
 
-        # sort by relatedness
-        all_texts_scored.sort(key=lambda x: x[1], reverse=True)
-
-        # take the top_n scores
-        top_texts = [{"id": x[0], "score": x[1]} for x in all_texts_scored[:top_n]]
-
         # save results
         results["success"] = True
-        results["texts"] = top_texts
+        results["texts"] = top_texts if isinstance(task_settings["query"], list) else top_texts[0]
     else:
         results["success"] = False
         results["response"] = response  # return entire response
         results["status"] = status  # return status code
 
 
+def iter_sentence_links(X, Y, top_n, sentences, block_size=COMPARE_BLOCK_SIZE):
+    """Yields lists of links between each query sentence and its `top_n` most similar document sentences.
+
+    `X` and `Y` are normalized embeddings of query and document sentences, and `sentences` is a tuple of lists of
+    source ids, char offsets and texts of all sentences, query sentences first. Sentence indexes in the links are
+    positions in these lists.
+
+    Links are yielded for a block of `block_size` query sentences at a time, so very large comparisons can be consumed
+    as they are computed (see `stream_links` in `run_openai_embedding_compare`). Similarity scores are computed in tiles
+    of at most `COMPARE_MAX_MEMORY` bytes by up to `COMPARE_MAX_WORKERS` threads. The links of each query sentence are
+    in document order.
+    """
+    source_id, all_sents_chars, all_sents_text = sentences
+    n_query_sents = len(X)
+    for start, indices, scores in embedding_search.iter_top_k_blocks(
+        X, Y, top_n, block_size, COMPARE_MAX_MEMORY, COMPARE_MAX_WORKERS
+    ):
+        order = np.argsort(indices, axis=1, kind="stable")
+        document_sent_index = (np.take_along_axis(indices, order, axis=1) + n_query_sents).ravel().tolist()
+        query_sent_index = np.repeat(np.arange(start, start + len(indices)), indices.shape[1]).tolist()
+        scores = np.take_along_axis(scores, order, axis=1).ravel().tolist()
+        yield [
+            {
+                "query_sent_index": q,
+                "document_sent_index": d,
+                "score": score,
+                "query_id": source_id[q],
+                "query_chars": all_sents_chars[q],
+                "query_sent": all_sents_text[q],
+                "document_id": source_id[d],
+                "document_chars": all_sents_chars[d],
+                "document_sent": all_sents_text[d],
+            }
+            for q, d, score in zip(query_sent_index, document_sent_index, scores)
+        ]
+
+
 def run_openai_embedding_compare(model_checkpoint, endpoint_params, task_settings, documents, results):
     """Make OpenAI API request to get embeddings of user query and compute pairwise similarity between query and documents.
 
@@ -454,6 +696,11 @@ def run_openai_embedding_compare(model_checkpoint, endpoint_params, task_setting
     For each sentence in the query, finds the sentence in any document with the highest similarity.
 
     Returns a list of query and document sentence pairs and relatedness scores.
+
+    Set `stream_links` in `task_settings` to send the links of each block of query sentences to the callback in
+    `LINKS_CALLBACK` as soon as they are computed, instead of collecting every link of a very large comparison in
+    `results["links"]`. The links are then left out of the results, which count them in `results["streamed_links"]`.
+    Without a callback (e.g., `/query`), links are collected as usual.
     """
     query = task_settings["query"]
 
@@ -463,22 +710,14 @@ def run_openai_embedding_compare(model_checkpoint, endpoint_params, task_setting
     all_sents_text = []
     all_sents_chars = []
 
-    i = 0
-    query_doc = NLP(query["text"])
-    for query_sent in query_doc.sents:
-        source_id.append(query["id"])
-        source_index.append(i)
-        all_sents_text.append(query_sent.text)
-        all_sents_chars.append([query_sent.start_char, query_sent.end_char])
-
-    for node in documents:
-        i += 1
-        node_doc = NLP(node["text"])
-        for node_sent in node_doc.sents:
-            source_id.append(node["id"])
+    sources = [query, *documents]
+    all_sents_spans = SENTENCE_SEGMENTER.split_many([source["text"] for source in sources])
+    for i, (source, sents_spans) in enumerate(zip(sources, all_sents_spans)):
+        for start_char, end_char in sents_spans:
+            source_id.append(source["id"])
             source_index.append(i)
-            all_sents_text.append(node_sent.text)
-            all_sents_chars.append([node_sent.start_char, node_sent.end_char])
+            all_sents_text.append(source["text"][start_char:end_char])
+            all_sents_chars.append([start_char, end_char])
 
     # make a request to OpenAI embedding endpoint and recieve response
     status, response, _ = openai_api.request_embedding_endpoint(model_checkpoint, all_sents_text, endpoint_params)
@@ -487,50 +726,31 @@ def run_openai_embedding_compare(model_checkpoint, endpoint_params, task_setting
         # get embeddings
         for i, be in enumerate(response["data"]):
             assert i == be["index"]  # double check embeddings are in same order as input
-        embeddings = [e["embedding"] for e in response["data"]]
+        embeddings = embedding_search.normalize_rows([e["embedding"] for e in response["data"]])
 
-        # reconstruct sentence sets with embeddings
-        sentences = pd.DataFrame(
-            {
-                "source_id": source_id,  # id of source that sentence is from
-                "source_index": source_index,  # index of source that sentence is from
-                "sent_chars": all_sents_chars,  # char offsets for sent span in source
-                "sent_text": all_sents_text,  # sentence text
-                "embedding": embeddings,  # embeddings from OpenAI
-            }
-        )
-
-        # get lists of query (X) and document (Y) embeddings to compare
-        X = sentences[sentences["source_index"] == 0]["embedding"].to_list()
-        Y = sentences[sentences["source_index"] > 0]["embedding"].to_list()
-
-        # compute pairwise cosine similarity
-        df = pd.DataFrame(cosine_similarity(X, Y))
-        n_query_sents = len(X)
-        df.columns = [col + n_query_sents for col in df.columns]
+        # get query (X) and document (Y) embeddings to compare, query sentences come first
+        n_query_sents = source_index.count(0)
+        X = embeddings[:n_query_sents]
+        Y = embeddings[n_query_sents:]
 
         # get top_n pairs of similarity between each query sentence and all document sentences
         top_n = task_settings["top_n"] if "top_n" in task_settings else 1
-        df_top = df.apply(pd.Series.nlargest, axis=1, n=top_n)
-        df_top = (
-            df_top.stack()
-            .reset_index()
-            .rename(columns={"level_0": "query_sent_index", "level_1": "document_sent_index", 0: "score"})
-        )
-
-        # map query and documents to sentences using sent_index
-        new_query_cols = ["query_id", "query_chars", "query_sent"]
-        new_document_cols = ["document_id", "document_chars", "document_sent"]
-        sentences_cols = ["source_id", "sent_chars", "sent_text"]
-        df_top[new_query_cols] = df_top["query_sent_index"].apply(lambda x: sentences.iloc[x][sentences_cols])
-        df_top[new_document_cols] = df_top["document_sent_index"].apply(lambda x: sentences.iloc[x][sentences_cols])
-
-        # get results as list of records
-        top_links = df_top.to_dict("records")
+        sentences = (source_id, all_sents_chars, all_sents_text)
+        on_links = LINKS_CALLBACK.get() if task_settings.get("stream_links", False) else None
+        top_links = []
+        n_streamed_links = 0
+        for links in iter_sentence_links(X, Y, top_n, sentences):
+            if on_links is not None:
+                on_links(links)  # send links of the block now, instead of holding every link until the end
+                n_streamed_links += len(links)
+            else:
+                top_links.extend(links)
 
         # save results
         results["success"] = True
         results["links"] = top_links
+        if on_links is not None:
+            results["streamed_links"] = n_streamed_links
     else:
         results["success"] = False
         results["response"] = response  # return entire response
@@ -0,0 +1,148 @@
+"""Rate limiter helper module.
+
+OpenAI limits the requests per minute (RPM) and tokens per minute (TPM) of each model, and answers requests over the
+limits with 429 errors. `RateLimiter` keeps a token bucket of requests and one of tokens for each model with limits, and
+holds requests that would go over them until the buckets refill, instead of sending them and retrying on 429s.
+
+Waiting requests are admitted in order of priority, then arrival, so interactive pile operations are sent before
+background work such as bulk ingestion.
+
+- See: <https://platform.openai.com/docs/guides/rate-limits>
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+PRIORITIES = {"interactive": 0, "background": 1}  # lower is admitted first
+BURST_SECONDS = 10  # buckets hold this many seconds of the per-minute limits, so a full bucket does not burst at once
+
+
+def estimate_request_tokens(data):
+    """Returns tokens OpenAI counts against the TPM limit for request `data`, before the request is tokenized.
+
+    Like OpenAI, input tokens are estimated from the number of characters, and chat requests also count `max_tokens`.
+    """
+    if "messages" in data:
+        n_chars = sum(len(message.get("content") or "") for message in data["messages"])
+        return n_chars // 4 + 4 * len(data["messages"]) + (data.get("max_tokens") or 0)
+    inputs = data.get("input", "")
+    inputs = [inputs] if isinstance(inputs, str) else inputs
+    return sum(len(x) if isinstance(x, str) else len(x) * 4 for x in inputs) // 4  # token arrays are exact
+
+
+class TokenBucket:
+    """Bucket of `capacity` units refilled at `rate` units per second, starting full."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        """Returns seconds until the bucket holds `amount` units, at most `capacity`."""
+        return max(min(amount, self.capacity) - self.level, 0) / self.rate
+
+
+class ModelRateLimit:
+    """Requests per minute and tokens per minute limits of a model.
+
+    A request is admitted once both buckets hold enough for it. A request larger than the tokens bucket is admitted
+    when the bucket is full, leaving it in debt, so later requests wait until the tokens it used have refilled.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm / 60, max(rpm * BURST_SECONDS / 60, 1)) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, max(tpm * BURST_SECONDS / 60, 1)) if tpm else None
+        self.admitted = 0
+        self.throttled = 0  # admitted requests that had to wait
+        self.waited = 0.0  # seconds waited by admitted requests
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, arrival, tokens) of waiting requests
+        self._arrivals = itertools.count()
+
+    def acquire(self, tokens, priority="interactive"):
+        """Waits until a request of `tokens` tokens is within the limits, returns seconds waited."""
+        start = time.monotonic()
+        ticket = (PRIORITIES.get(priority, 0), next(self._arrivals), tokens)
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket:
+                    now = time.monotonic()
+                    wait = 0.0
+                    for bucket, amount in [(self.requests, 1), (self.tokens, tokens)]:
+                        if bucket is not None:
+                            bucket.refill(now)
+                            wait = max(wait, bucket.seconds_until(amount))
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()  # woken when the request in front is admitted
+            heapq.heappop(self._waiting)
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= tokens
+            waited = time.monotonic() - start
+            self.admitted += 1
+            self.throttled += 1 if waited > 0.001 else 0
+            self.waited += waited
+            self._cond.notify_all()
+        return waited
+
+    def stats(self):
+        """Returns dict of limits, available requests and tokens, and counts of admitted and waiting requests."""
+        with self._cond:
+            now = time.monotonic()
+            for bucket in [self.requests, self.tokens]:
+                if bucket is not None:
+                    bucket.refill(now)
+            waiting = {name: 0 for name in PRIORITIES}
+            for priority, _, _ in self._waiting:
+                name = next((x for x, value in PRIORITIES.items() if value == priority), "interactive")
+                waiting[name] += 1
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "available_requests": self.requests.level if self.requests is not None else None,
+                "available_tokens": self.tokens.level if self.tokens is not None else None,
+                "waiting": waiting,
+                "admitted": self.admitted,
+                "throttled": self.throttled,
+                "waited_seconds": self.waited,
+            }
+
+
+class RateLimiter:
+    """Rate limits of each model, see `ModelRateLimit`. Models without limits are not limited."""
+
+    def __init__(self, limits=None):
+        self._limits = {model: ModelRateLimit(rpm, tpm) for model, (rpm, tpm) in (limits or {}).items()}
+
+    def acquire(self, model_checkpoint, tokens, priority="interactive"):
+        """Waits until a request of `tokens` tokens to `model_checkpoint` can be sent, returns seconds waited."""
+        limit = self._limits.get(model_checkpoint)
+        if limit is None:
+            return 0.0
+        return limit.acquire(tokens, priority)
+
+    def stats(self):
+        """Returns dict of `ModelRateLimit.stats` of each model with limits."""
+        return {model: limit.stats() for model, limit in self._limits.items()}
@@ -0,0 +1,131 @@
+"""Sentence segmentation helper module.
+
+`SentenceSegmenter` splits texts into sentences with a spaCy pipeline that only runs the components needed to find
+sentence boundaries, and segments many texts at once with `nlp.pipe`. Sentence spans of recently segmented texts are
+kept in memory, keyed by a hash of the text, so documents that are compared again are not segmented again.
+
+- See: <https://spacy.io/usage/linguistic-features#sbd>
+- See: <https://spacy.io/usage/processing-pipelines#processing>
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+# components of the trained pipeline that are not needed to find sentence boundaries in each mode
+EXCLUDED_COMPONENTS = {
+    "senter": ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner"],
+    "parser": ["tagger", "senter", "attribute_ruler", "lemmatizer", "ner"],
+}
+
+
+def hash_text(text):
+    """Returns content address of `text`."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SentenceSegmenter:
+    """Splits texts into sentences, caching the character offsets of sentences of each text.
+
+    - `model_path`: path or name of a trained spaCy pipeline, such as `en_core_web_sm`
+    - `mode`: "senter" for the statistical sentence recognizer (fast), "parser" for the dependency parser (most
+      accurate, what `nlp(text).sents` uses by default) or "sentencizer" for punctuation rules (fastest, no model)
+    - `batch_size`: texts processed together by `nlp.pipe`
+    - `n_process`: processes used by `nlp.pipe` for large batches of texts, 1 segments in the calling thread
+    - `max_entries`: texts kept in the cache before least recently used ones are evicted
+
+    The pipeline is loaded the first time it is needed.
+    """
+
+    def __init__(self, model_path, mode="senter", batch_size=64, n_process=1, max_entries=10000):
+        if mode not in ("senter", "parser", "sentencizer"):
+            raise ValueError(f"unknown sentence segmentation mode: {mode}")
+        self.model_path = model_path
+        self.mode = mode
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._nlp = None
+        self._entries = OrderedDict()  # key -> sentence offsets, ordered from least to most recently used
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def nlp(self):
+        """Returns spaCy pipeline, loading it on first use."""
+        with self._load_lock:
+            if self._nlp is None:
+                import spacy  # imported on first use, so processes that never compare sentences do not load it
+
+                if self.mode == "sentencizer":
+                    nlp = spacy.blank("en")
+                    nlp.add_pipe("sentencizer")
+                else:
+                    nlp = spacy.load(self.model_path, exclude=EXCLUDED_COMPONENTS[self.mode])
+                    if self.mode == "senter":
+                        nlp.enable_pipe("senter")  # disabled by default in trained pipelines
+                print(f" * loaded sentence segmentation pipeline: {nlp.pipe_names}")
+                self._nlp = nlp
+            return self._nlp
+
+    @property
+    def loaded(self):
+        """Returns True if the pipeline has been loaded."""
+        return self._nlp is not None
+
+    def split_many(self, texts):
+        """Returns list of `(start_char, end_char)` offsets of sentences of each of `texts`.
+
+        Only texts that are not cached are segmented, together in batches.
+        """
+        keys = [hash_text(text) for text in texts]
+        spans = [None] * len(texts)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    spans[i] = self._entries[key]
+
+        # segment each distinct missing text once
+        missing = {}
+        for i, key in enumerate(keys):
+            if spans[i] is None:
+                missing.setdefault(key, []).append(i)
+        if len(missing) > 0:
+            missing_texts = [texts[indexes[0]] for indexes in missing.values()]
+            n_process = self.n_process if len(missing_texts) > self.batch_size else 1  # not worth forking for a few
+            docs = self.nlp.pipe(missing_texts, batch_size=self.batch_size, n_process=n_process)
+            new_spans = [tuple((sent.start_char, sent.end_char) for sent in doc.sents) for doc in docs]
+            with self._lock:
+                for (key, indexes), doc_spans in zip(missing.items(), new_spans):
+                    for i in indexes:
+                        spans[i] = doc_spans
+                    self._entries[key] = doc_spans
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        with self._lock:
+            self.hits += len(texts) - sum(len(indexes) for indexes in missing.values())
+            self.misses += sum(len(indexes) for indexes in missing.values())
+        return spans
+
+    def stats(self):
+        """Returns dict of cache size and hit / miss counts."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,97 @@
+"""Request coalescing helper module.
+
+`SingleFlight` makes concurrent callers with the same key share a single call: the first caller runs it, and callers
+that arrive while it is still in flight wait for it and get its result instead of running it again. Unlike the response
+caches in `openai_cache.py`, nothing is kept once the call returns, so coalescing is always safe to turn on.
+"""
+
+import copy
+import threading
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+class _Call:
+    """Call in flight, with its result or error once `done` is set."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one.
+
+    Counts of calls that were run and calls that were coalesced into another since the server started are kept in
+    `calls` and `coalesced`.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> `_Call`
+
+    def do(self, key, fn, copy_result=False):
+        """Returns result of `fn()` and whether it was shared with a call of the same `key` that was already in flight.
+
+        Exceptions raised by `fn` are raised in every caller of the call. If `copy_result` is set, each caller gets its
+        own copy of the result, so callers may modify it.
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    if self._in_flight.get(key) is call:
+                        del self._in_flight[key]  # later callers make a new call
+                call.done.set()
+            return copy.deepcopy(call.result) if copy_result else call.result, False
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result) if copy_result else call.result, True
+
+    def detach(self, key):
+        """Stops callers from joining the call of `key` in flight, if no caller has joined it yet.
+
+        Called from `fn` by the caller running it, so it can abort the call (e.g. once its caller is cancelled) without
+        failing callers that share it. Returns True if the call was detached, False if other callers share it.
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None or call.waiters > 0:
+                return False
+            del self._in_flight[key]  # later callers make a new call
+            return True
+
+    def stats(self):
+        """Returns dict of calls in flight, and counts of calls that were run and coalesced."""
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "waiting": sum(call.waiters for call in self._in_flight.values()),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
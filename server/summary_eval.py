@@ -0,0 +1,98 @@
+"""Summary evaluation helper module.
+
+`SummaryEvaluator` loads the ROUGE metric once and reuses it for every summary, instead of resolving and importing the
+metric module on each request. Summaries can also be scored in a background thread, so the summary is returned as soon
+as the LLM finishes and the scores are fetched later by evaluation id.
+
+- See: <https://huggingface.co/spaces/evaluate-metric/rouge>
+"""
+
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import openai_api
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+def get_reference_text(documents):
+    """Returns reference text of a summary of `documents`, cleaned like in the prompt (see `openai_api.clean_document`)."""
+    return "".join([openai_api.clean_document(doc) for doc in documents])
+
+
+class SummaryEvaluator:
+    """Scores summaries against the documents they summarize with ROUGE.
+
+    - `max_workers`: background threads scoring summaries submitted with `submit`
+    - `max_results`: scores of submitted summaries kept for `get` before the oldest are dropped
+
+    The metric is loaded the first time it is needed, or ahead of time with `load`.
+    """
+
+    def __init__(self, max_workers=1, max_results=1000):
+        self.max_results = max_results
+        self._rouge = None
+        self._load_lock = threading.Lock()
+        self._compute_lock = threading.Lock()  # metric modules are not safe to compute from several threads at once
+        self._results = OrderedDict()  # evaluation id -> evaluation, ordered from oldest to newest
+        self._results_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary-eval")
+
+    def load(self):
+        """Returns ROUGE metric, loading it on first use."""
+        with self._load_lock:
+            if self._rouge is None:
+                import evaluate  # imported on first use, so processes that never summarize do not load it
+
+                self._rouge = evaluate.load("rouge")
+                print(" * loaded ROUGE metric")
+            return self._rouge
+
+    @property
+    def loaded(self):
+        """Returns True if the metric has been loaded."""
+        return self._rouge is not None
+
+    def score(self, summary_text, documents):
+        """Returns dict of ROUGE-1, ROUGE-2 and ROUGE-L scores of `summary_text` against `documents`."""
+        rouge = self.load()
+        text = get_reference_text(documents)
+        with self._compute_lock:
+            rouge_result = rouge.compute(predictions=[summary_text], references=[text], use_stemmer=True)
+        return {
+            "rouge1": rouge_result["rouge1"],
+            "rouge2": rouge_result["rouge2"],
+            "rougeL": rouge_result["rougeL"],
+        }
+
+    def submit(self, summary_text, documents):
+        """Scores `summary_text` in a background thread and returns an evaluation id to `get` the scores with."""
+        evaluation_id = uuid.uuid4().hex
+        with self._results_lock:
+            self._results[evaluation_id] = {"status": "pending"}
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        self._executor.submit(self._run, evaluation_id, summary_text, documents)
+        return evaluation_id
+
+    def _run(self, evaluation_id, summary_text, documents):
+        try:
+            evaluation = {"status": "done", **self.score(summary_text, documents)}
+        except Exception as e:
+            print(f"summary evaluation {evaluation_id} failed: {e}")
+            evaluation = {"status": "failed", "error": str(e)}
+        with self._results_lock:
+            if evaluation_id in self._results:
+                self._results[evaluation_id] = evaluation
+
+    def get(self, evaluation_id):
+        """Returns evaluation with its `status` ("pending", "done" or "failed") and scores, or None if unknown."""
+        with self._results_lock:
+            evaluation = self._results.get(evaluation_id)
+            return dict(evaluation) if evaluation is not None else None
@@ -0,0 +1,128 @@
+"""Token cache helper module.
+
+`TokenCache` keeps the `tiktoken` tokens of recently used texts in memory, keyed by a hash of the encoding name and
+text, so the documents of a pile are only tokenized the first time any task formats a prompt with them. Least recently
+used texts are evicted once more than `max_tokens` tokens are held in memory, and can optionally be spilled to a
+SQLite file on disk instead of being dropped.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+def hash_text(encoding_name, text):
+    """Returns content address of `text` tokenized with `encoding_name`."""
+    return hashlib.sha256(f"{encoding_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """Size-bounded cache of tokens of texts, held in memory as uint32 arrays.
+
+    - `max_tokens`: total tokens held in memory before least recently used texts are evicted
+    - `spill_path`: optional SQLite file that evicted texts are written to and read back from on a memory miss
+    - `max_spill_entries`: texts kept in the spill file before least recently used ones are deleted
+    """
+
+    def __init__(self, max_tokens=50_000_000, spill_path=None, max_spill_entries=100_000):
+        self.max_tokens = max_tokens
+        self.max_spill_entries = max_spill_entries
+        self.hits = 0
+        self.misses = 0
+        self.n_tokens = 0
+        self._entries = OrderedDict()  # key -> tokens, ordered from least to most recently used
+        self._lock = threading.Lock()
+        self._conn = None
+        if spill_path is not None:
+            os.makedirs(os.path.dirname(spill_path), exist_ok=True)
+            self._conn = sqlite3.connect(spill_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tokens (
+                    key TEXT PRIMARY KEY,
+                    tokens BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tokens_last_used ON tokens (last_used)")
+            self._conn.commit()
+
+    def encode_many(self, encoding, texts):
+        """Returns list of uint32 token arrays of `texts`, only tokenizing texts that are not cached."""
+        keys = [hash_text(encoding.name, text) for text in texts]
+        tokens = [None] * len(texts)
+        with self._lock:
+            for i, key in enumerate(keys):
+                tokens[i] = self._get(key)
+        missing = [i for i, x in enumerate(tokens) if x is None]
+        if len(missing) > 0:
+            new_tokens = encoding.encode_batch([texts[i] for i in missing])
+            with self._lock:
+                for i, x in zip(missing, new_tokens):
+                    tokens[i] = np.asarray(x, dtype=np.uint32)
+                    self._put(keys[i], tokens[i])
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return tokens
+
+    def _get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self._conn is not None:
+            row = self._conn.execute("SELECT tokens FROM tokens WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE tokens SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+                tokens = np.frombuffer(row[0], dtype=np.uint32)
+                self._put(key, tokens)
+                return tokens
+        return None
+
+    def _put(self, key, tokens):
+        if key in self._entries:
+            return
+        self._entries[key] = tokens
+        self.n_tokens += len(tokens)
+        evicted = []
+        while self.n_tokens > self.max_tokens and len(self._entries) > 1:
+            evicted_key, evicted_tokens = self._entries.popitem(last=False)
+            self.n_tokens -= len(evicted_tokens)
+            evicted.append((evicted_key, evicted_tokens))
+        if self._conn is not None and len(evicted) > 0:
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", [(k, t.tobytes(), now) for k, t in evicted]
+            )
+            (n_entries,) = self._conn.execute("SELECT COUNT(*) FROM tokens").fetchone()
+            if n_entries > self.max_spill_entries:
+                self._conn.execute(
+                    "DELETE FROM tokens WHERE key IN (SELECT key FROM tokens ORDER BY last_used LIMIT ?)",
+                    (n_entries - self.max_spill_entries,),
+                )
+            self._conn.commit()
+
+    def stats(self):
+        """Returns dict of cache size and hit / miss counts."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "tokens": self.n_tokens,
+                "max_tokens": self.max_tokens,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
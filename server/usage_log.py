@@ -0,0 +1,225 @@
+"""Token usage log helper module.
+
+`UsageLog` counts the tokens used by each request to the OpenAI API without touching the disk on the request path:
+`record` only puts the usage of a request on a queue. A background thread periodically folds queued usage into
+in-memory counts by model, task and minute, and appends it to `usage.jsonl` in `data/usage`. Once the log grows past
+`compact_every` entries, the counts are written to `usage.json` and the log starts over.
+
+On startup, counts are loaded from `usage.json` and the entries of `usage.jsonl` written after it. The totals of each
+model are also written to the `tokens_used_<model>.json` files, which older versions updated on every request.
+"""
+
+import atexit
+import fnmatch
+import json
+import os
+import queue
+import threading
+import time
+
+
+__author__ = "Adam Coscia"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__email__ = "acoscia125@gmail.com"
+
+
+BUCKET_SECONDS = 60  # usage is counted by minute, the finest window `/token-usage` can report
+COUNT_FIELDS = ["requests", "input", "output", "total"]
+
+
+def add_counts(counts, other):
+    """Adds `other` counts to `counts` in place and returns `counts`."""
+    for field in COUNT_FIELDS:
+        counts[field] = counts.get(field, 0) + other.get(field, 0)
+    return counts
+
+
+class UsageLog:
+    """Counts of tokens used by model, task and minute, persisted to an append-only log in `path`.
+
+    - `flush_interval`: seconds between writes of recorded usage to the log
+    - `compact_every`: entries in the log before it is compacted into a snapshot of the counts
+    """
+
+    def __init__(self, path, flush_interval=5, compact_every=10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.log_path = os.path.join(path, "usage.jsonl")
+        self.snapshot_path = os.path.join(path, "usage.json")
+        self._queue = queue.SimpleQueue()  # usage entries recorded since the last drain
+        self._buckets = {}  # (minute, model, task) -> counts
+        self._unwritten = []  # drained entries not yet appended to the log
+        self._last_response = None  # written to `response.json` with the next flush, for debugging
+        self._seq = 0  # sequence number of the last entry, entries up to the `seq` of the snapshot are compacted
+        self._log_entries = 0
+        self._lock = threading.Lock()  # guards counts, only taken by the flusher and readers, not by `record`
+        self._flush_lock = threading.Lock()
+        self._loaded = False
+        self._thread = None
+
+    def record(self, model, task, input_tokens, output_tokens, total_tokens):
+        """Records usage of a request to `model` for `task` (None if unknown)."""
+        self._queue.put((time.time(), model, task, input_tokens, output_tokens, total_tokens))
+        if self._thread is None:
+            self._start()
+
+    def record_response(self, response):
+        """Keeps `response` of the last request to write to `response.json` with the next flush."""
+        self._last_response = response
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._flush_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)  # write usage recorded since the last flush on shutdown
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"usage log flush failed: {e}")
+
+    def load(self):
+        """Loads counts persisted in `path`, once, before counting new usage."""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if os.path.isfile(self.snapshot_path):
+                with open(self.snapshot_path, "r") as f:
+                    snapshot = json.load(f)
+                self._seq = snapshot["seq"]
+                for minute, model, task, counts in snapshot["buckets"]:
+                    self._buckets[(minute, model, task)] = counts
+            elif not os.path.isfile(self.log_path):
+                self._load_legacy()
+            if os.path.isfile(self.log_path):
+                with open(self.log_path, "r") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # partially written entry of a crash
+                        self._log_entries += 1
+                        if entry["seq"] > self._seq:
+                            self._seq = entry["seq"]
+                            self._add(entry)
+
+    def _load_legacy(self):
+        """Starts counts from the totals in `tokens_used_<model>.json` files, without a task or time."""
+        for file in sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []:
+            if fnmatch.fnmatch(file, "tokens_used_*.json"):
+                with open(os.path.join(self.path, file), "r") as f:
+                    counts = json.load(f)
+                model = file[len("tokens_used_") : -len(".json")]
+                self._buckets[(0, model, None)] = add_counts({}, counts)
+
+    def _add(self, entry):
+        key = (int(entry["time"] // BUCKET_SECONDS * BUCKET_SECONDS), entry["model"], entry["task"])
+        add_counts(self._buckets.setdefault(key, {}), entry)
+
+    def _drain(self):
+        """Folds queued usage into the counts, must hold `_lock`."""
+        while True:
+            try:
+                timestamp, model, task, input_tokens, output_tokens, total_tokens = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._seq += 1
+            entry = {
+                "seq": self._seq,
+                "time": timestamp,
+                "model": model,
+                "task": task,
+                "requests": 1,
+                "input": input_tokens or 0,
+                "output": output_tokens or 0,
+                "total": total_tokens or 0,
+            }
+            self._add(entry)
+            self._unwritten.append(entry)
+
+    def flush(self):
+        """Appends recorded usage to the log, compacting it if needed, and updates the files of each model."""
+        with self._flush_lock:
+            self.load()
+            with self._lock:
+                self._drain()
+                entries, self._unwritten = self._unwritten, []
+                response, self._last_response = self._last_response, None
+            os.makedirs(self.path, exist_ok=True)
+            if response is not None:
+                with open(os.path.join(self.path, "response.json"), "w") as f:
+                    f.write(json.dumps(response))
+            if len(entries) == 0:
+                return
+            with open(self.log_path, "a") as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            self._log_entries += len(entries)
+            if self._log_entries >= self.compact_every:
+                self.compact()
+            totals = self.aggregate()["models"]
+            for model in {entry["model"] for entry in entries}:
+                tokens_used = {field: totals[model][field] for field in ["input", "output", "total"]}
+                self._write_json(os.path.join(self.path, f"tokens_used_{model}.json"), tokens_used, indent=2)
+
+    def compact(self):
+        """Writes counts to the snapshot and empties the log, must hold `_flush_lock`."""
+        with self._lock:
+            buckets = [[minute, model, task, counts] for (minute, model, task), counts in self._buckets.items()]
+            seq = self._seq  # entries drained but not in the log yet are counted here and skipped when loaded
+        self._write_json(self.snapshot_path, {"seq": seq, "buckets": buckets})
+        # the snapshot is written first, so a crash before the log is emptied does not count its entries twice
+        open(self.log_path, "w").close()
+        self._log_entries = 0
+        print(f" * compacted usage log into {len(buckets)} buckets")
+
+    @staticmethod
+    def _write_json(path, data, indent=None):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(tmp_path, path)  # readers never see a partially written file
+
+    def aggregate(self, window=None, interval=None, model=None, task=None):
+        """Returns dict of tokens used in total, by model, by task and by model and task.
+
+        - `window`: only count usage in the last `window` seconds, all usage by default
+        - `interval`: also count usage in consecutive `interval` seconds (rounded to minutes) in `series`
+        - `model` / `task`: only count usage of a model or task
+        """
+        self.load()
+        if interval is not None:
+            interval = max(int(interval) // BUCKET_SECONDS, 1) * BUCKET_SECONDS
+        since = time.time() - window if window is not None else None
+        with self._lock:
+            self._drain()
+            buckets = list(self._buckets.items())
+        total = add_counts({}, {})
+        models, tasks, models_tasks, series = {}, {}, {}, {}
+        for (minute, bucket_model, bucket_task), counts in buckets:
+            if since is not None and minute + BUCKET_SECONDS <= since:
+                continue
+            if (model is not None and bucket_model != model) or (task is not None and bucket_task != task):
+                continue
+            task_name = bucket_task if bucket_task is not None else "unknown"
+            add_counts(total, counts)
+            add_counts(models.setdefault(bucket_model, {}), counts)
+            add_counts(tasks.setdefault(task_name, {}), counts)
+            add_counts(models_tasks.setdefault(bucket_model, {}).setdefault(task_name, {}), counts)
+            if interval is not None and minute > 0:
+                start = minute // interval * interval
+                add_counts(series.setdefault(start, {"start": start}), counts)
+        usage = {"total": total, "models": models, "tasks": tasks, "models_tasks": models_tasks}
+        if window is not None:
+            usage["window"] = window
+        if interval is not None:
+            usage["series"] = [series[start] for start in sorted(series)]
+        return usage